@@ -0,0 +1,89 @@
+import json
+import sys
+import threading
+import time
+from http.client import HTTPConnection
+
+# Round trip of one sorting move (a servo, the conveyor motor and a stepper)
+# sent to the Motors node as three requests or as one /batch request, over
+# one keep-alive connection, run on CPython:
+#   python3 bench_batch.py [moves] [host:port]
+# Without a host, the node is stood in by a Microdot app on localhost with
+# the same endpoints, whose handlers only start a thread, as the ones of
+# main.py do. With the host of the board, the commands are sent to it: the
+# servo goes to 90 degrees and the motor and the stepper are given no time
+# and no steps.
+
+COMMANDS = [{'type': 'servo', 'id': 1, 'angle': 90},
+            {'type': 'motor', 'id': 0, 'time': 0, 'direction': 1},
+            {'type': 'stepper', 'id': 0, 'steps': 0, 'speed': 5000}]
+PATHS = ['/servo/1?angle=90',
+         '/motors/0?time=0&direction=1',
+         '/stepper/0?steps=0&speed=5000']
+
+
+def stand_in(port):
+    from microdot import Microdot
+
+    app = Microdot()
+
+    def work():
+        time.sleep(0.001)
+
+    @app.post('/servo/<identifier>')
+    def servo(request, identifier):
+        threading.Thread(target=work).start()
+        return 'OK'
+
+    @app.post('/motors/<identifier>')
+    def motors(request, identifier):
+        threading.Thread(target=work).start()
+        return 'OK'
+
+    @app.post('/stepper/<identifier>')
+    def stepper(request, identifier):
+        threading.Thread(target=work).start()
+        return 'OK'
+
+    @app.post('/batch')
+    def batch(request):
+        len(request.json)
+        threading.Thread(target=work).start()
+        return 'OK'
+
+    threading.Thread(target=app.run, daemon=True,
+                     kwargs={'host': '127.0.0.1', 'port': port}).start()
+    time.sleep(0.3)
+
+
+def run(connection, moves):
+    def post(path, body=None):
+        headers = {'Content-Type': 'application/json'} if body else {}
+        connection.request('POST', path, body=body, headers=headers)
+        return connection.getresponse().read()
+
+    def per_command():
+        for path in PATHS:
+            post(path)
+
+    def batch():
+        post('/batch', json.dumps(COMMANDS))
+
+    for name, send in (('three requests', per_command), ('one batch', batch)):
+        send()
+        start = time.perf_counter()
+        for _ in range(moves):
+            send()
+        print('{0:14}: {1:.2f} ms per move'.format(
+            name, (time.perf_counter() - start) / moves * 1000))
+
+
+if __name__ == '__main__':
+    moves = int(sys.argv[1]) if len(sys.argv) > 1 else 300
+    if len(sys.argv) > 2:
+        host, _, port = sys.argv[2].partition(':')
+        port = int(port or 80)
+    else:
+        host, port = '127.0.0.1', 5810
+        stand_in(port)
+    run(HTTPConnection(host, port), moves)
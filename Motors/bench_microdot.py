@@ -0,0 +1,334 @@
+import sys
+
+from microdot import Microdot, Request, Response
+
+# Checks and benchmarks of the threaded Microdot server, run on CPython next
+# to microdot.py (the copy in Sensors is the same):
+#   python3 bench_microdot.py check
+# writes responses with each kind of body back to back, as on a keep-alive
+# connection, and reads them back with http.client to check their framing.
+#   python3 bench_microdot.py router [lookups]
+# checks that find_route gives the same results as a linear scan of the URL
+# map, as it did before the routes were indexed, and times both with 5, 50
+# and 500 routes, for the last route registered and for a path no route
+# matches.
+#   python3 bench_microdot.py keepalive [requests] [port]
+# serves POST /relay/<int:id> on localhost and sends the requests with
+# http.client, on a new connection each and then all on one keep-alive
+# connection, then pipelines 31 requests on one socket.
+#   python3 bench_microdot.py write [responses]
+# counts the stream writes of a JSON response and of a 5000 byte file and the
+# bytes allocated for the JSON response, and
+# times the JSON response written to a socket pair, against writing each
+# line on its own as Response.write did before the write buffer.
+
+
+def check():
+    import io
+    from http.client import HTTPResponse
+
+    class _Stream(io.BytesIO):
+        # HTTPResponse closes the stream at the end of each response
+        def close(self):
+            pass
+
+    class _Connection:
+        # what HTTPResponse needs of a socket, reading from a buffer
+        def __init__(self, data):
+            self.stream = _Stream(data)
+
+        def makefile(self, mode):
+            return self.stream
+
+    bodies = [
+        ('bytes', lambda: b'hello'),
+        ('bytearray', lambda: bytearray(b'hello')),
+        ('str', lambda: 'hello'),
+        ('generator', lambda: iter([b'he', b'', b'llo'])),
+        ('file', lambda: io.BytesIO(b'hello')),
+    ]
+    app = Microdot()
+    failed = 0
+    for name, body in bodies:
+        for http_version in ('1.0', '1.1'):
+            stream = io.BytesIO()
+            count = 0
+            keep_alive = True
+            while keep_alive and count < 2:
+                req = Request(app, None, 'GET', '/', http_version, {})
+                res = Response(body())
+                count += 1
+                keep_alive = app._keep_alive(req, res, count)
+                res.write(stream)
+            connection = _Connection(stream.getvalue())
+            try:
+                bodies_read = []
+                for _ in range(count):
+                    response = HTTPResponse(connection)
+                    response.begin()
+                    bodies_read.append(response.read())
+                ok = bodies_read == [b'hello'] * count and \
+                    not connection.stream.read()
+            except Exception as exc:
+                bodies_read = exc
+                ok = False
+            failed += not ok
+            framing = res.headers.get('Transfer-Encoding') or \
+                ('Content-Length' if 'Content-Length' in res.headers
+                 else 'close')
+            print('{name:9} HTTP/{version} {framing:14} {count} '
+                  'response(s): {result}'.format(
+                      name=name, version=http_version, framing=framing,
+                      count=count, result='ok' if ok else
+                      'FAILED ' + repr(bodies_read)))
+    return failed
+
+
+def linear_find_route(app, req):
+    # find_route before URLRouter
+    f = 404
+    for route_methods, route_pattern, route_handler in app.url_map:
+        req.url_args = route_pattern.match(req.path)
+        if req.url_args is not None:
+            if req.method in route_methods:
+                f = route_handler
+                break
+            else:
+                f = 405
+    return f
+
+
+def router(lookups):
+    from time import perf_counter
+
+    def app_with(count):
+        app = Microdot()
+        patterns = ['/', '/status', '/colour', '/metal',
+                    '/piezo/<int:identifier>']
+        i = 0
+        while len(patterns) < count:
+            patterns += ['/api/v{0}/item/<int:id>'.format(i),
+                         '/api/v{0}/name/<name>'.format(i),
+                         '/static{0}'.format(i),
+                         '/files{0}/<path:name>'.format(i)]
+            i += 1
+        for i, pattern in enumerate(patterns[:count]):
+            methods = ['GET'] if i % 3 else ['GET', 'POST']
+            app.route(pattern, methods=methods)(lambda req, **args: None)
+        return app, patterns[count - 1]
+
+    def time_us(find_route, app, req):
+        start = perf_counter()
+        for _ in range(lookups):
+            find_route(app, req)
+        return (perf_counter() - start) / lookups * 1000000
+
+    failed = 0
+    for count in (5, 50, 500):
+        app, last = app_with(count)
+        last = last.replace('<int:id>', '7').replace('<name>', 'bob') \
+            .replace('<path:name>', 'a/b').replace('<int:identifier>', '2')
+        paths = ['/', '/status', '/piezo/2', '/piezo/x', '/api/v1/item/3',
+                 '/api/v1/item/a', '/api/v2/name/bob', '/static3',
+                 '/files4/a/b', '/files1/', '', 'status', '//status',
+                 '/status/', '/missing', last]
+        for path in paths:
+            for method in ('GET', 'POST', 'PUT'):
+                indexed = Request(app, None, method, path, '1.1', {})
+                linear = Request(app, None, method, path, '1.1', {})
+                f = Microdot.find_route(app, indexed)
+                if f != linear_find_route(app, linear) or \
+                        (callable(f) and
+                         indexed.url_args != linear.url_args):
+                    print('MISMATCH', count, method, path)
+                    failed += 1
+        times = []
+        for path in (last, '/missing/path'):
+            req = Request(app, None, 'GET', path, '1.1', {})
+            times.append((time_us(linear_find_route, app, req),
+                          time_us(Microdot.find_route, app, req)))
+        print('{count:3} routes: last route linear {0:6.1f} us, indexed '
+              '{1:4.1f} us; miss linear {2:6.1f} us, indexed {3:4.1f} us'
+              .format(times[0][0], times[0][1], times[1][0], times[1][1],
+                      count=count))
+    return failed
+
+
+def keep_alive_benchmark(requests, port):
+    import socket as _socket
+    import threading
+    from http.client import HTTPConnection
+    from time import perf_counter, sleep
+
+    app = Microdot()
+
+    @app.post('/relay/<int:identifier>')
+    def relay(request, identifier):
+        return 'OK'
+
+    threading.Thread(target=app.run, daemon=True,
+                     kwargs={'host': '127.0.0.1', 'port': port}).start()
+    sleep(0.3)
+
+    start = perf_counter()
+    for _ in range(requests):
+        connection = HTTPConnection('127.0.0.1', port)
+        connection.request('POST', '/relay/1?enable=1',
+                           headers={'Connection': 'close'})
+        connection.getresponse().read()
+        connection.close()
+    print('new connection per request: {0:6.0f} req/s'.format(
+        requests / (perf_counter() - start)))
+
+    connection = HTTPConnection('127.0.0.1', port)
+    start = perf_counter()
+    for _ in range(requests):
+        connection.request('POST', '/relay/1?enable=1')
+        connection.getresponse().read()
+    print('keep-alive:                 {0:6.0f} req/s ({1} requests per '
+          'connection at most)'.format(requests / (perf_counter() - start),
+                                       Microdot.max_keep_alive_requests))
+    connection.close()
+
+    sock = _socket.create_connection(('127.0.0.1', port))
+    sock.sendall(b'POST /relay/1 HTTP/1.1\r\nHost: x\r\n\r\n' * 30 +
+                 b'POST /relay/1 HTTP/1.1\r\nConnection: close\r\n\r\n')
+    data = b''
+    while True:
+        chunk = sock.recv(65536)
+        if not chunk:
+            break
+        data += chunk
+    sock.close()
+    print('31 pipelined requests: {0} responses'.format(
+        data.count(b'HTTP/1.1 200')))
+    app.shutdown()
+    return data.count(b'HTTP/1.1 200') != 31
+
+
+def line_write(res, stream):
+    # Response.write before the write buffer
+    res.complete()
+    reason = res.reason if res.reason is not None else \
+        ('OK' if res.status_code == 200 else 'N/A')
+    stream.write('HTTP/{http_version} {status_code} {reason}\r\n'.format(
+        http_version=res.http_version, status_code=res.status_code,
+        reason=reason).encode())
+    for header, value in res.headers.items():
+        values = value if isinstance(value, list) else [value]
+        for value in values:
+            stream.write('{header}: {value}\r\n'.format(
+                header=header, value=value).encode())
+    stream.write(b'\r\n')
+    for body in res.body_iter():
+        stream.write(body)
+        stream.flush()
+
+
+def write_benchmark(responses):
+    import gc
+    import io
+    import os
+    import socket as _socket
+    import tempfile
+    import threading
+    from time import perf_counter
+
+    class _CountingStream:
+        def __init__(self):
+            self.writes = 0
+            self.flushes = 0
+
+        def write(self, data):
+            self.writes += 1
+
+        def flush(self):
+            self.flushes += 1
+
+    def colour():
+        res = Response({'red': 12, 'green': 34, 'blue': 5})
+        res.http_version = '1.1'
+        res.headers['Connection'] = 'keep-alive'
+        return res
+
+    def allocated(write):
+        # bytes allocated to write a JSON response, after a first one that
+        # sets up the write buffer; on CPython, the most held at once
+        write(colour(), _CountingStream())
+        res = colour()
+        if hasattr(gc, 'mem_alloc'):
+            gc.collect()
+            gc.disable()
+            before = gc.mem_alloc()
+            write(res, _CountingStream())
+            after = gc.mem_alloc()
+            gc.enable()
+        else:
+            import tracemalloc
+            tracemalloc.start()
+            before = tracemalloc.get_traced_memory()[0]
+            write(res, _CountingStream())
+            after = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+        return after - before
+
+    fd, filename = tempfile.mkstemp()
+    os.write(fd, b'x' * 5000)
+    os.close(fd)
+    writers = (('line by line', line_write),
+               ('buffered', lambda res, stream: res.write(stream)))
+    for name, write in writers:
+        stream = _CountingStream()
+        write(colour(), stream)
+        line = '{name:12}: JSON response {writes} writes, {flushes} ' \
+            'flushes'.format(name=name, writes=stream.writes,
+                             flushes=stream.flushes)
+        stream = _CountingStream()
+        write(Response.send_file(filename), stream)
+        print(line + '; 5000 byte file {writes} writes; {0} bytes '
+              'allocated per JSON response'.format(allocated(write),
+                                                  writes=stream.writes))
+    os.remove(filename)
+
+    for name, write in writers:
+        server, client = _socket.socketpair()
+
+        def drain():
+            while client.recv(65536):
+                pass
+
+        threading.Thread(target=drain, daemon=True).start()
+        stream = server.makefile('rwb', buffering=0)
+        pending = [colour() for _ in range(responses)]
+        start = perf_counter()
+        for res in pending:
+            write(res, stream)
+        print('{name:12}: {0:.1f} us per JSON response to a socket '
+              'pair'.format((perf_counter() - start) / responses * 1000000,
+                            name=name))
+        stream.close()
+        server.close()
+
+        pending = [colour() for _ in range(responses)]
+        stream = io.BytesIO()
+        start = perf_counter()
+        for res in pending:
+            write(res, stream)
+        print('{name:12}: {0:.1f} us per JSON response to a BytesIO'
+              .format((perf_counter() - start) / responses * 1000000,
+                      name=name))
+
+
+if __name__ == '__main__':
+    command = sys.argv[1] if len(sys.argv) > 1 else 'check'
+    if command == 'check':
+        sys.exit(1 if check() else 0)
+    elif command == 'router':
+        lookups = int(sys.argv[2]) if len(sys.argv) > 2 else 2000
+        sys.exit(1 if router(lookups) else 0)
+    elif command == 'keepalive':
+        requests = int(sys.argv[2]) if len(sys.argv) > 2 else 2000
+        port = int(sys.argv[3]) if len(sys.argv) > 3 else 5123
+        sys.exit(1 if keep_alive_benchmark(requests, port) else 0)
+    elif command == 'write':
+        write_benchmark(int(sys.argv[2]) if len(sys.argv) > 2 else 20000)
@@ -0,0 +1,126 @@
+import asyncio
+import json
+import subprocess
+import sys
+import time
+
+# Load test of the asyncio Microdot server against the threaded one, run on
+# CPython next to microdot_asyncio.py (the copy in Sensors is the same):
+#   python3 bench_microdot_asyncio.py [async|threaded] [requests] [port]
+# starts the server in a child process, serving GET /colour on localhost with
+# a 5 ms wait standing in for the sensor, from one event loop or from a
+# thread per connection. 1, 10 and 100 clients then send their requests on
+# one keep-alive connection each, and the latencies, the rate and the most
+# memory traced in the server process are reported; the clients run in this
+# process, so their buffers are not counted.
+#   python3 bench_microdot_asyncio.py serve [async|threaded] [port]
+# runs the server alone, GET /memory returns the peak traced since the last
+# GET /memory.
+
+
+def serve(engine, port):
+    import tracemalloc
+
+    colour = {'red': 12, 'green': 34, 'blue': 5}
+    if engine == 'async':
+        from microdot_asyncio import Microdot
+        app = Microdot()
+
+        @app.get('/colour')
+        async def get_colour(request):
+            await asyncio.sleep(0.005)
+            return colour
+
+        options = {}
+    else:
+        from microdot import Microdot
+        app = Microdot()
+
+        @app.get('/colour')
+        def get_colour(request):
+            time.sleep(0.005)
+            return colour
+
+        options = {'workers': 0}
+
+    @app.get('/memory')
+    def get_memory(request):
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.reset_peak()
+        return {'peak': peak}
+
+    tracemalloc.start()
+    app.run(host='127.0.0.1', port=port, **options)
+
+
+async def client(port, path, requests, latencies=None):
+    # sends the requests on one keep-alive connection, returns the last body
+    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+    request = 'GET {0} HTTP/1.1\r\nHost: x\r\n\r\n'.format(path).encode()
+    for _ in range(requests):
+        start = time.perf_counter()
+        writer.write(request)
+        await writer.drain()
+        head = await reader.readuntil(b'\r\n\r\n')
+        length = int(head.split(b'Content-Length: ')[1].split(b'\r\n')[0])
+        body = await reader.readexactly(length)
+        if latencies is not None:
+            latencies.append(time.perf_counter() - start)
+    writer.close()
+    return body
+
+
+async def load(engine, requests, port):
+    await wait_for(port)
+    for clients in (1, 10, 100):
+        # starts a new peak
+        await client(port, '/memory', 1)
+        latencies = []
+        start = time.perf_counter()
+        results = await asyncio.gather(
+            *[client(port, '/colour', requests, latencies)
+              for _ in range(clients)], return_exceptions=True)
+        # the threaded server listens with a backlog of 5, with 100 clients
+        # connecting at once some of them can be reset
+        reset = len([result for result in results
+                     if isinstance(result, ConnectionError)])
+        elapsed = time.perf_counter() - start
+        peak = json.loads(await client(port, '/memory', 1))['peak']
+        latencies.sort()
+        print('{engine} {clients:3} clients: p50 {0:5.1f} ms, '
+              'p95 {1:5.1f} ms, {2:5.0f} req/s, server peak traced '
+              '{3:5.0f} KiB, {4} connections reset'
+              .format(latencies[len(latencies) // 2] * 1000,
+                      latencies[int(len(latencies) * 0.95)] * 1000,
+                      len(latencies) / elapsed, peak / 1024, reset,
+                      engine=engine, clients=clients))
+
+
+async def wait_for(port, timeout=5):
+    # until the server answers, which also warms it up
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            await client(port, '/colour', 1)
+            return
+        except OSError:
+            if time.monotonic() > deadline:
+                raise
+            await asyncio.sleep(0.1)
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1 and sys.argv[1] == 'serve':
+        serve(sys.argv[2] if len(sys.argv) > 2 else 'async',
+              int(sys.argv[3]) if len(sys.argv) > 3 else 5130)
+    else:
+        engine = sys.argv[1] if len(sys.argv) > 1 else 'async'
+        requests = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+        port = int(sys.argv[3]) if len(sys.argv) > 3 else 5130
+        server = subprocess.Popen([sys.executable, __file__, 'serve', engine,
+                                   str(port)])
+        try:
+            asyncio.run(load(engine, requests, port))
+        finally:
+            server.terminate()
+            server.wait()
@@ -0,0 +1,319 @@
+# controller.py
+
+# one motion controller for all the stepper axes
+
+# the controller starts the moves on the channels of a shared
+# stepgen.StepGenerator and returns at once: the steps of every axis come
+# from the same tick callback, in time order, instead of one busy-waiting
+# thread per axis; move_together() makes a coordinated move, where the axis
+# with the most steps follows its acceleration profile and the others step
+# along with it (bresenham), so all of them start and end together
+
+# each axis has a queue of moves: append() starts a move when the axis is
+# free or queues it after the others, replace() stops the axis and starts
+# the new move, flush() drops the queued moves; the next queued move is
+# started from the generator when a move ends, so queued moves follow each
+# other without a round trip; status() reports the position, the remaining
+# steps and the time until the queue is done
+
+# the position of each axis is kept up to date when its move ends or when
+# it is read with position()
+
+# this module does not use machine, run it to simulate a coordinated move
+# with recording pins and check the pulse timing, then replace() on one of
+# its axes while another moves alone, and a queued move that follows one
+# ending while the lock is held:
+#   python3 controller.py
+
+# -----------------------------------------------
+# imports
+# -----------------------------------------------
+
+import _thread
+from motion import Move
+
+# -----------------------------------------------
+# controller
+# -----------------------------------------------
+
+
+class MotionController:
+
+    def __init__(self,
+                 drivers,  # steppers.A4899 axes, created with the generator
+                 generator  # stepgen.StepGenerator
+                 ):
+        self.drivers = drivers
+        self.generator = generator
+        self.origin = [driver.steps for driver in drivers]
+        self.sign = [1] * len(drivers)
+        self.queues = [[] for _ in drivers]  # (steps, move, pause_ms)
+        self.current = [None] * len(drivers)  # (leading axis, move)
+        self.lock = _thread.allocate_lock()
+        self.pending = False  # a move ended, _done found the lock taken
+        for axis, driver in enumerate(drivers):
+            driver.channel.axis = axis
+            driver.channel.done = self._done
+
+    def running(self, axis=None):
+        # moving, or with moves in its queue
+        if axis is None:
+            for axis in range(len(self.drivers)):
+                if self.running(axis):
+                    return True
+            return False
+        return self.drivers[axis].channel.running or bool(self.queues[axis])
+
+    def position(self, axis):
+        driver = self.drivers[axis]
+        index = driver.channel.index
+        driver.steps = self.origin[axis] + self.sign[axis] * index
+        return driver.steps
+
+    def move(self, axis, steps, sps=None):
+        # start a move on one axis, False if the axis is still moving
+        return self.move_together({axis: steps}, sps)
+
+    def move_together(self, steps, sps=None):
+        # start a coordinated move, steps: {axis: steps}, sps: speed of the
+        # axis with the most steps; False if any of the axes is still moving
+        for axis in steps:
+            if self.running(axis):
+                return False
+        if not steps:
+            return True
+
+        # the axis with the most steps leads
+        lead = None
+        for axis in steps:
+            if lead is None or abs(steps[axis]) > abs(steps[lead]):
+                lead = axis
+        move = self._plan(lead, steps[lead], sps)
+
+        followers = []
+        for axis in steps:
+            self._prepare(axis, steps[axis])
+            self.current[axis] = (lead, move)
+            if axis != lead:
+                followers.append((self.drivers[axis].channel,
+                                  abs(steps[axis])))
+        self.generator.start(self.drivers[lead].channel, move, followers)
+        return True
+
+    def _plan(self, axis, steps, sps):
+        driver = self.drivers[axis]
+        # no faster than the generator can step, the callers that take a
+        # speed from outside refuse the faster ones (see main.py)
+        sps = min(sps or driver.sps, self.generator.max_sps)
+        if driver.profile:
+            return driver.profile.plan(steps, sps)
+        return Move(abs(steps), (), 0, int(round(1000000 / max(1, sps), 0)),
+                    (), 0)
+
+    def append(self, axis, steps, sps=None, pause=0):
+        # queue a move, it starts `pause` milliseconds after the previous one
+        # ends, or from now if the axis is free
+        move = self._plan(axis, steps, sps)
+        self.lock.acquire()
+        try:
+            self.queues[axis].append((steps, move, pause))
+            self._next(axis)
+        finally:
+            self._unlock()
+
+    def replace(self, axis, steps, sps=None, pause=0):
+        # stop the axis (and the axes of the coordinated move it is still
+        # part of) and start this move instead of the queued ones
+        move = self._plan(axis, steps, sps)
+        self.lock.acquire()
+        try:
+            del self.queues[axis][:]
+            self.generator.cancel(self.drivers[axis].channel)
+            self.queues[axis].append((steps, move, pause))
+            self._next(axis)
+        finally:
+            self._unlock()
+
+    def flush(self, axis):
+        # drop the queued moves, the current one goes on
+        self.lock.acquire()
+        try:
+            del self.queues[axis][:]
+        finally:
+            self._unlock()
+
+    def _next(self, axis):
+        # start the next queued move of a free axis, with the lock held
+        queue = self.queues[axis]
+        channel = self.drivers[axis].channel
+        if queue and not channel.running:
+            steps, move, pause = queue.pop(0)
+            self._prepare(axis, steps)
+            self.current[axis] = (axis, move)
+            self.generator.start(channel, move, delay=pause * 1000)
+
+    def _done(self, channel):
+        # scheduled by the generator when a move ends; if the lock is taken,
+        # its holder starts the queued moves before releasing it
+        self.pending = True
+        if self.lock.acquire(0):
+            self._unlock()
+
+    def _unlock(self):
+        # start the queued moves of the axes whose move ended while the lock
+        # was held, then release it
+        while self.pending:
+            self.pending = False
+            for axis in range(len(self.drivers)):
+                self._next(axis)
+        self.lock.release()
+        # a move that ended between the check and the release
+        if self.pending and self.lock.acquire(0):
+            self._unlock()
+
+    def idle(self, axis):
+        # no move running or queued
+        self.lock.acquire()
+        try:
+            self._next(axis)
+            return not self.drivers[axis].channel.running
+        finally:
+            self._unlock()
+
+    def status(self, axis):
+        self.lock.acquire()
+        try:
+            self._next(axis)
+            channel = self.drivers[axis].channel
+            queue = self.queues[axis]
+            remaining = channel.steps - channel.index
+            eta = 0
+            if channel.running:
+                lead, move = self.current[axis]
+                lead_channel = self.drivers[lead].channel
+                eta = max(self.generator.until(lead_channel), 0) + \
+                    move.duration_us(lead_channel.index)
+            for steps, move, pause in queue:
+                remaining += abs(steps)
+                eta += pause * 1000 + move.duration_us()
+            return {'position': self.position(axis),
+                    'running': channel.running,
+                    'remaining_steps': remaining,
+                    'queued': len(queue),
+                    'eta_ms': (eta + 999) // 1000}
+        finally:
+            self._unlock()
+
+    def _prepare(self, axis, steps):
+        # direction and wake, with the position of the last move settled
+        driver = self.drivers[axis]
+        self.origin[axis] = self.position(axis)
+        if steps < 0:
+            driver.pd.value(driver.reverse)
+            self.sign[axis] = -1
+        else:
+            driver.pd.value(driver.forward)
+            self.sign[axis] = 1
+        if driver.isoff:
+            driver.wake()
+
+    def stop(self, axis=None):
+        # stop and flush the queue
+        self.lock.acquire()
+        try:
+            for i in range(len(self.drivers)):
+                if axis is None or i == axis:
+                    del self.queues[i][:]
+                    self.generator.cancel(self.drivers[i].channel)
+        finally:
+            self._unlock()
+
+
+# -----------------------------------------------
+# simulation
+# -----------------------------------------------
+
+if __name__ == '__main__':
+    from motion import Profile, SCURVE
+    from stepgen import ManualTicks, StepGenerator
+
+    class RecordingPin:
+        # records the clock of each rising edge
+        def __init__(self, clock):
+            self.clock = clock
+            self.state = 0
+            self.edges = []
+
+        def value(self, v=None):
+            if v is None:
+                return self.state
+            if v and not self.state:
+                self.edges.append(self.clock())
+            self.state = v
+
+    class Axis:
+        # the parts of steppers.A4899 the controller uses
+        def __init__(self, generator, profile):
+            self.ps = RecordingPin(generator.clock)
+            self.pd = RecordingPin(generator.clock)
+            self.forward, self.reverse = 0, 1
+            self.isoff = False
+            self.steps = 0
+            self.sps = 200
+            self.profile = profile
+            self.channel = generator.add(self.ps)
+
+    ticks = ManualTicks()
+    generator = StepGenerator(ticks, max_sps=20000)
+    profile = Profile(accel=20000, start_sps=400, curve=SCURVE)
+    axes = [Axis(generator, profile) for _ in range(3)]
+    controller = MotionController(axes, generator)
+
+    moves = {0: 6000, 1: -2000, 2: 4500}
+    controller.move_together(moves, 4000)
+    callbacks = 0
+    while controller.running():
+        ticks.tick()
+        callbacks += 1
+    plan = profile.plan(6000, 4000)
+
+    lead = axes[0].ps.edges
+    expected = [0]
+    for i in range(len(lead) - 1):
+        expected.append(expected[-1] + plan.interval(i))
+    errors = [abs((t - lead[0]) - e) for t, e in zip(lead, expected)]
+    print('lead pulses: {0}, planned duration: {1} us, simulated: {2} us'
+          .format(len(lead), plan.duration_us(), lead[-1] - lead[0]))
+    print('lead timing error: max {0} us, {1} timer callbacks'
+          .format(max(errors), callbacks))
+    edges = set(lead)
+    for axis, steps in moves.items():
+        pulses = axes[axis].ps.edges
+        print('axis {0}: {1} pulses for {2} steps, position {3}, '
+              'all on lead pulses: {4}, last pulse {5} us before the lead\'s'
+              .format(axis, len(pulses), steps, controller.position(axis),
+                      set(pulses) <= edges, lead[-1] - pulses[-1]))
+
+    # replace() on an axis that followed the last move stops only that axis
+    controller.move(0, 1000, 1000)
+    ticks.tick(10)
+    controller.replace(1, 100, 1000)
+    while controller.running():
+        ticks.tick(1000)
+    print('axis 0 alone: {0} of 1000 steps after replace() on axis 1'
+          .format(controller.position(0) - moves[0]))
+
+    # a move that ends while a request holds the lock: the next queued move
+    # starts when the lock is released, not on the next status()
+    controller.append(2, 100, 1000)
+    controller.append(2, 100, 1000)
+    controller.lock.acquire()
+    while axes[2].channel.running:
+        ticks.tick()
+    controller._unlock()
+    print('second queued move started at the release: {0}'
+          .format(axes[2].channel.running))
+
+# -----------------------------------------------
+# end
+# -----------------------------------------------
@@ -3,18 +3,36 @@ import steppers
 from microdot import Microdot
 from machine import Pin, PWM
 import network
-from utime import sleep
+from utime import sleep, sleep_ms, ticks_add, ticks_diff, ticks_ms
 from l298 import L298
+from motion import Profile, SCURVE
+from stepgen import StepGenerator, TimerTicks
+from controller import MotionController
 
 ap = wlan = network.WLAN(network.STA_IF)
 print(ap.ifconfig())
 
+# Acceleration profile shared by the steppers, the moves ramp up from
+# start_sps to the requested speed and back down instead of starting and
+# stopping at full speed
+profile = Profile(accel=20000,  # steps/s^2
+                  start_sps=400,  # steps-per-second without a ramp
+                  curve=SCURVE,
+                  )
+
+# Step pulses from a one-shot timer armed for the next step due, the request
+# threads only wait for the moves to end; the speeds above max_sps are
+# refused (the metal gate of the process moves at 20000)
+generator = StepGenerator(TimerTicks(0), max_sps=20000)
+
 print('Motor 1')
 m1 = steppers.A4899(26,  # step
                     17,  # direction
                     enable=21,  # enable pin
                     sleep=False,  # start in sleep mode
                     sps=200,  # steps-per-second
+                    profile=profile,  # ramp up and down
+                    generator=generator,  # steps from the timer
                     )
 
 print('Motor 2')
@@ -23,6 +41,8 @@ m2 = steppers.A4899(25,  # step
                     enable=21,  # enable pin
                     sleep=False,  # start in sleep mode
                     sps=200,  # steps-per-second
+                    profile=profile,  # ramp up and down
+                    generator=generator,  # steps from the timer
                     )
 
 print('Motor 3')
@@ -31,6 +51,8 @@ m3 = steppers.A4899(27,  # step
                     enable=21,  # enable pin
                     sleep=False,  # start in sleep mode
                     sps=200,  # steps-per-second
+                    profile=profile,  # ramp up and down
+                    generator=generator,  # steps from the timer
                     )
 
 print('Motor 4')
@@ -39,6 +61,8 @@ m4 = steppers.A4899(18,  # step
                     enable=21,  # enable pin
                     sleep=False,  # start in sleep mode
                     sps=200,  # steps-per-second
+                    profile=profile,  # ramp up and down
+                    generator=generator,  # steps from the timer
                     )
 
 print('Motor 5')
@@ -47,6 +71,8 @@ m5 = steppers.A4899(14,  # step
                     enable=21,  # enable pin
                     sleep=False,  # start in sleep mode
                     sps=200,  # steps-per-second
+                    profile=profile,  # ramp up and down
+                    generator=generator,  # steps from the timer
                     )
 
 stepper_drivers = [m1, m2, m3, m4, m5]
@@ -55,6 +81,9 @@ for stepper in stepper_drivers:
     stepper.sleepis = 1
     stepper.step(0, 0)
 
+# All the axes step from the generator, no thread per move
+controller = MotionController(stepper_drivers, generator)
+
 # Servo motors region
 print('Servo motors')
 # Free PWM pins are 15, 4, 22, 23, 12, 13, 32 and 33
@@ -82,13 +111,118 @@ motor_drivers.append(pump)
 motor.speed(1023)
 pump.speed(1023)
 
+
+def map_val(x, in_min, in_max, out_min, out_max):
+    return int((x - in_min) * (out_max - out_min) / (in_max - in_min) + out_min)
+
+
+def run_motor(m, t_on: float, direction: int):
+    if isinstance(m, L298):
+        if direction == 1:
+            m.forward()
+        elif direction == -1:
+            m.reverse()
+        sleep(t_on)
+        m.stop()
+
+
+# Estimated end of the servo and DC motor moves, for the wait endpoints
+SERVO_MS_PER_DEGREE = 3  # about 0.17 s per 60 degrees
+servo_angles = [None] * len(servo_motors)  # None until the first move
+servo_until = [ticks_ms()] * len(servo_motors)
+motor_until = [ticks_ms()] * len(motor_drivers)
+
+
+def set_servo(identifier, duty, angle):
+    last = servo_angles[identifier]
+    travel = 180 if last is None else abs(angle - last)
+    servo_motors[identifier].duty(duty)
+    servo_angles[identifier] = angle
+    servo_until[identifier] = ticks_add(ticks_ms(), travel * SERVO_MS_PER_DEGREE)
+
+
+def start_motor(identifier, direction, t_on_ms):
+    m = motor_drivers[identifier]
+    if direction == 1:
+        m.forward()
+    else:
+        m.reverse()
+    motor_until[identifier] = ticks_add(ticks_ms(), t_on_ms)
+
+
+def wait_until(done, timeout):
+    # long poll, True once done() is true, False after timeout seconds
+    deadline = ticks_add(ticks_ms(), int(timeout * 1000))
+    while not done():
+        if ticks_diff(deadline, ticks_ms()) <= 0:
+            return False
+        sleep_ms(10)
+    return True
+
+
+# Batches of commands, scheduled from a single thread
+batch_generation = 0  # incremented by /stop to cancel the pending commands
+
+
+def batch_events(command):
+    # translate a command into (start offset in ms, function, arguments)
+    # events; raises KeyError, IndexError or ValueError if it is not valid
+    kind = command['type']
+    identifier = int(command['id'])
+    offset = int(float(command.get('delay', 0)) * 1000)
+    if offset < 0:
+        raise ValueError('negative delay')
+    if kind == 'stepper':
+        if not 0 <= identifier < len(stepper_drivers):
+            raise IndexError(identifier)
+        speed = int(command['speed'])
+        if speed > generator.max_sps:
+            raise ValueError(speed)
+        # queued after the moves already running on the axis
+        return [(offset, controller.append,
+                 (identifier, int(command['steps']), speed))]
+    elif kind == 'servo':
+        if not 0 <= identifier < len(servo_motors):
+            raise IndexError(identifier)
+        angle = int(command['angle'])
+        if angle > 180 or angle < 0:
+            raise ValueError(angle)
+        return [(offset, set_servo,
+                 (identifier, map_val(angle, 0, 180, 40, 115), angle))]
+    elif kind == 'motor':
+        if not 0 <= identifier < len(motor_drivers):
+            raise IndexError(identifier)
+        direction = int(command['direction'])
+        if direction not in (1, -1):
+            raise ValueError(direction)
+        t_on = int(float(command['time']) * 1000)
+        # the motor is stopped by a later event instead of a sleeping thread
+        return [(offset, start_motor, (identifier, direction, t_on)),
+                (offset + t_on, L298.stop, (motor_drivers[identifier],))]
+    raise ValueError(kind)
+
+
+def run_batch(events, generation):
+    start = ticks_ms()
+    for offset, _, action, args in events:
+        if generation != batch_generation:
+            # cancelled, only the DC motors that were started still need a stop
+            if action is L298.stop:
+                action(*args)
+            continue
+        wait = ticks_diff(ticks_add(start, offset), ticks_ms())
+        if wait > 0:
+            sleep_ms(wait)
+        action(*args)
+
+
 print('Define microdot app')
 
 app = Microdot()
 
 
-@app.route("/")
-def index():
+@app.route("/", cache=True)
+def index(request):
     return "Hello World!"
 
 
@@ -101,20 +235,86 @@ def stepper(request, identifier):
     identifier = int(identifier)
     steps = int(request.args['steps'])
     speed = int(request.args['speed'])
-    if identifier > len(stepper_drivers):
+    if identifier > len(stepper_drivers) or speed > generator.max_sps:
         return 'FAIL'
-    if stepper_drivers[identifier].running:
+    if not controller.move(identifier, steps, speed):
+        return 'ALREADY RUNNING'
+    return 'OK'
+
+
+@app.get("/stepper/<int:identifier>")
+def stepper_status(request, identifier):
+    if identifier >= len(stepper_drivers):
+        return 'FAIL'
+    return controller.status(identifier)
+
+
+@app.get("/stepper/<int:identifier>/wait")
+def stepper_wait(request, identifier):
+    # long poll until the queued moves of the stepper end, ?timeout=s
+    if identifier >= len(stepper_drivers):
+        return 'FAIL'
+    done = wait_until(lambda: controller.idle(identifier),
+                      float(request.args.get('timeout', 30)))
+    status = controller.status(identifier)
+    status['done'] = done
+    return status
+
+
+@app.post("/stepper/<int:identifier>/append")
+def stepper_append(request, identifier):
+    # queue a move after the ones of the stepper, ?pause=ms waits between
+    speed = int(request.args['speed'])
+    if identifier >= len(stepper_drivers) or speed > generator.max_sps:
+        return 'FAIL'
+    controller.append(identifier, int(request.args['steps']), speed,
+                      int(request.args.get('pause', 0)))
+    return 'OK'
+
+
+@app.post("/stepper/<int:identifier>/replace")
+def stepper_replace(request, identifier):
+    # stop the stepper and start this move instead of the queued ones
+    speed = int(request.args['speed'])
+    if identifier >= len(stepper_drivers) or speed > generator.max_sps:
+        return 'FAIL'
+    controller.replace(identifier, int(request.args['steps']), speed)
+    return 'OK'
+
+
+@app.post("/stepper/<int:identifier>/flush")
+def stepper_flush(request, identifier):
+    # drop the queued moves, the current one goes on
+    if identifier >= len(stepper_drivers):
+        return 'FAIL'
+    controller.flush(identifier)
+    return 'OK'
+
+
+@app.post("/move")
+def move(request):
+    # coordinated move of several steppers, they start and end together:
+    # {"steps": [0, 1500, 0, -300, 0], "speed": 2000}, the speed is the one
+    # of the stepper with the most steps
+    print('Move received')
+    try:
+        steps = request.json['steps']
+        speed = int(request.json['speed'])
+        if len(steps) > len(stepper_drivers) or speed > generator.max_sps:
+            return 'FAIL'
+        moves = {}
+        for axis, axis_steps in enumerate(steps):
+            if int(axis_steps):
+                moves[axis] = int(axis_steps)
+    except (KeyError, TypeError, ValueError):
+        return 'FAIL'
+    if not controller.move_together(moves, speed):
         return 'ALREADY RUNNING'
-    _thread.start_new_thread(stepper_drivers[identifier].step, (steps, speed))
-    # stepper_drivers[identifier].step(steps, speed)
     return 'OK'
 
 
 @app.post("/servo/<identifier>")
 def servos(request, identifier):
-    def map_val(x, in_min, in_max, out_min, out_max):
-        return int((x - in_min) * (out_max - out_min) / (in_max - in_min) + out_min)
-
     print('Data received')
     print('angle: {0}'.format(request.args['angle']))
     print('ID: {0}'.format(identifier))
@@ -123,22 +323,23 @@ def servos(request, identifier):
     if identifier > len(servo_motors) or angle > 180 or angle < 0:
         return 'FAIL'
     # Servo control here
-    _thread.start_new_thread(servo_motors[identifier].duty, (map_val(angle, 0, 180, 40, 115),))
-    # _thread.start_new_thread(servo_motors[identifier].duty(map_val(angle, 0, 180, 20, 120)))
+    set_servo(identifier, map_val(angle, 0, 180, 40, 115), angle)
     return 'OK'
 
 
+@app.get("/servo/<int:identifier>/wait")
+def servo_wait(request, identifier):
+    # long poll until the servo is estimated to be in position, ?timeout=s
+    if identifier >= len(servo_motors):
+        return 'FAIL'
+    done = wait_until(
+        lambda: ticks_diff(servo_until[identifier], ticks_ms()) <= 0,
+        float(request.args.get('timeout', 30)))
+    return {'done': done}
+
+
 @app.post("/motors/<identifier>")
 def motors(request, identifier):
-    def run_motor(m, t_on: float, direction: int):
-        if isinstance(m, L298):
-            if direction == 1:
-                m.forward()
-            elif direction == -1:
-                m.reverse()
-            sleep(t_on)
-            m.stop()
-
     print('Data received')
     print('Time: {0}'.format(request.args['time']))
     print('Direction: {0}'.format(request.args['direction']))
@@ -146,26 +347,68 @@ def motors(request, identifier):
     identifier = int(identifier)
     if identifier > len(motor_drivers):
         return 'FAIL'
+    motor_until[identifier] = ticks_add(ticks_ms(), int(float(request.args['time']) * 1000))
     _thread.start_new_thread(run_motor, (motor_drivers[identifier], float(request.args['time']),
                                          int(request.args['direction']),))
     return 'OK'
 
 
+@app.get("/motors/<int:identifier>/wait")
+def motors_wait(request, identifier):
+    # long poll until the DC motor stops, ?timeout=s
+    if identifier >= len(motor_drivers):
+        return 'FAIL'
+    done = wait_until(
+        lambda: ticks_diff(motor_until[identifier], ticks_ms()) <= 0,
+        float(request.args.get('timeout', 30)))
+    return {'done': done}
+
+
+@app.post("/batch")
+def batch(request):
+    # a JSON list of commands, all scheduled from this request:
+    # {"type": "stepper", "id": 0, "steps": 100, "speed": 1000}
+    # {"type": "servo", "id": 0, "angle": 90}
+    # {"type": "motor", "id": 0, "time": 1.5, "direction": 1}
+    # each one with an optional "delay", in seconds from the request
+    print('Batch received')
+    try:
+        events = []
+        for command in request.json:
+            for offset, action, args in batch_events(command):
+                # the index keeps the order of the events at the same offset
+                events.append((offset, len(events), action, args))
+    except (KeyError, IndexError, TypeError, ValueError) as exc:
+        print('Invalid batch: {0}'.format(exc))
+        return 'FAIL'
+    events.sort()
+    _thread.start_new_thread(run_batch, (events, batch_generation))
+    return 'OK'
+
+
 @app.post("/stop")
 def stop(request):
-    def map_val(x, in_min, in_max, out_min, out_max):
-        return int((x - in_min) * (out_max - out_min) / (in_max - in_min) + out_min)
+    global batch_generation
 
     print('Stop all process')
-    for s in stepper_drivers:
-        if s.running:
-            s.stop = True
-    for servo in servo_motors:
-        servo.duty(map_val(180, 0, 180, 20, 120))
+    batch_generation += 1
+    controller.stop()
+    for identifier in range(len(servo_motors)):
+        set_servo(identifier, map_val(180, 0, 180, 20, 120), 180)
     return 'OK'
 
 
-@app.route("/status")
+@app.get("/jitter")
+def jitter(request):
+    # deviation of the step intervals from the planned ones, since the last
+    # reset (?reset=1)
+    stats = generator.stats()
+    if request.args.get('reset'):
+        generator.reset_stats()
+    return stats
+
+
+@app.route("/status", cache=True)
 def status(request):
     return 'OK'
 
@@ -33,6 +33,28 @@ except ImportError:  # pragma: no cover
 
     concurrency_mode = 'sync'
 
+try:  # pragma: no cover
+    from _thread import allocate_lock, get_ident
+except ImportError:  # pragma: no cover
+    allocate_lock = None
+
+    def get_ident():
+        return 0
+
+try:
+    from time import ticks_ms, ticks_add, ticks_diff
+except ImportError:  # pragma: no cover
+    from time import monotonic
+
+    def ticks_ms():
+        return int(monotonic() * 1000)
+
+    def ticks_add(ticks, delta):
+        return ticks + delta
+
+    def ticks_diff(ticks1, ticks2):
+        return ticks1 - ticks2
+
 try:
     import ujson as json
 except ImportError:
@@ -51,6 +73,13 @@ except ImportError:
     except ImportError:  # pragma: no cover
         socket = None
 
+MUTED_SOCKET_ERRORS = [
+    32,  # Broken pipe
+    54,  # Connection reset by peer
+    104,  # Connection reset by peer
+    128,  # Operation on closed socket
+]
+
 
 def urldecode(string):
     string = string.replace('+', ' ')
@@ -221,6 +250,9 @@ class Request():
         self.g = Request.G()
 
         self.http_version = http_version
+        #: Whether the client can reuse the connection for more requests,
+        #: as given by the HTTP version and the ``Connection`` header.
+        self.keep_alive = http_version == '1.1'
         if '?' in self.path:
             self.path, self.query_string = self.path.split('?', 1)
             self.args = self._parse_urlencoded(self.query_string)
@@ -235,6 +267,13 @@ class Request():
                 for cookie in value.split(';'):
                     name, value = cookie.strip().split('=', 1)
                     self.cookies[name] = value
+            elif header == 'connection':
+                for option in value.lower().split(','):
+                    option = option.strip()
+                    if option == 'close':
+                        self.keep_alive = False
+                    elif option == 'keep-alive':
+                        self.keep_alive = True
 
         self._body = body
         self.body_used = False
@@ -268,8 +307,7 @@ class Request():
             line = Request._safe_readline(client_stream).strip().decode()
             if line == '':
                 break
-            header, value = line.split(':', 1)
-            value = value.strip()
+            header, value = Request._split_header(line)
             headers[header] = value
 
         return Request(app, client_addr, method, url, http_version, headers,
@@ -357,6 +395,13 @@ class Request():
         self.after_request_handlers.append(f)
         return f
 
+    @staticmethod
+    def _split_header(line):
+        header, sep, value = line.partition(':')
+        if not sep or not header.strip():
+            raise ValueError('malformed header line')
+        return header, value.strip()
+
     @staticmethod
     def _safe_readline(stream):
         line = stream.readline(Request.max_readline + 1)
@@ -365,6 +410,25 @@ class Request():
         return line
 
 
+_write_buffers = {}
+
+
+def _buffered_write(stream, buf, n, data):
+    # append data to the first n bytes of buf, a memoryview of the write
+    # buffer, writing it out when it fills up; returns the new number of
+    # buffered bytes
+    size = len(data)
+    if n + size > len(buf):
+        if n:
+            stream.write(buf[:n])
+            n = 0
+        if size > len(buf):
+            stream.write(data)
+            return 0
+    buf[n:n + size] = data
+    return n + size
+
+
 class Response():
     """An HTTP response class.
 
@@ -392,10 +456,26 @@ class Response():
     }
     send_file_buffer_size = 1024
 
+    #: The size of the buffer where the status line, the headers and small
+    #: bodies are serialized, so that most responses are sent with a single
+    #: write. The buffer is allocated once per thread and reused.
+    write_buffer_size = 1024
+
+    _status_lines = {}
+    _header_names = {}
+
     #: The content type to use for responses that do not explicitly define a
     #: ``Content-Type`` header.
     default_content_type = 'text/plain'
 
+    #: The HTTP version written in the status line. The server switches it
+    #: to ``'1.1'`` when responding to HTTP/1.1 requests.
+    http_version = '1.0'
+
+    #: Set by the server to ``True`` or ``False`` to send a ``Connection:
+    #: keep-alive`` or ``Connection: close`` header with the response.
+    keep_alive = None
+
     def __init__(self, body='', status_code=200, headers=None, reason=None):
         if body is None and status_code == 200:
             body = ''
@@ -449,44 +529,148 @@ class Response():
             self.headers['Set-Cookie'] = [http_cookie]
 
     def complete(self):
-        if isinstance(self.body, bytes) and \
+        if isinstance(self.body, (bytes, bytearray)) and \
                 'Content-Length' not in self.headers:
             self.headers['Content-Length'] = str(len(self.body))
+        elif self.body and self.http_version == '1.1' and \
+                'Content-Length' not in self.headers and \
+                'Transfer-Encoding' not in self.headers:
+            # streamed body of unknown length
+            self.headers['Transfer-Encoding'] = 'chunked'
         if 'Content-Type' not in self.headers:
             self.headers['Content-Type'] = self.default_content_type
 
     def write(self, stream):
         self.complete()
+        buf = Response._write_buffer()
+        n = 0
 
         # status code
-        reason = self.reason if self.reason is not None else \
-            ('OK' if self.status_code == 200 else 'N/A')
-        stream.write('HTTP/1.0 {status_code} {reason}\r\n'.format(
-            status_code=self.status_code, reason=reason).encode())
+        n = _buffered_write(stream, buf, n, self._status_line())
 
         # headers
+        names = Response._header_names
         for header, value in self.headers.items():
+            if header == 'Connection' and self.keep_alive is not None:
+                continue
+            name = names.get(header)
+            if name is None:
+                name = (header + ': ').encode()
+                if len(names) < 32:
+                    names[header] = name
             values = value if isinstance(value, list) else [value]
             for value in values:
-                stream.write('{header}: {value}\r\n'.format(
-                    header=header, value=value).encode())
-        stream.write(b'\r\n')
+                n = _buffered_write(stream, buf, n, name)
+                n = _buffered_write(stream, buf, n, str(value).encode())
+                n = _buffered_write(stream, buf, n, b'\r\n')
+        n = _buffered_write(stream, buf, n, self._connection_header())
+        n = _buffered_write(stream, buf, n, b'\r\n')
 
         # body
         can_flush = hasattr(stream, 'flush')
+        chunked = self.headers.get('Transfer-Encoding') == 'chunked'
         try:
-            for body in self.body_iter():
-                if isinstance(body, str):  # pragma: no cover
-                    body = body.encode()
-                stream.write(body)
-                if can_flush:  # pragma: no cover
-                    stream.flush()
+            if isinstance(self.body, (bytes, bytearray)):
+                n = _buffered_write(stream, buf, n, self.body)
+            elif self.body and hasattr(self.body, 'readinto'):
+                n = self._write_file(stream, buf, n, chunked)
+            else:
+                for body in self.body_iter():
+                    if isinstance(body, str):  # pragma: no cover
+                        body = body.encode()
+                    if not body:
+                        # an empty chunk would end a chunked body
+                        continue
+                    if chunked:
+                        size = '{size:x}\r\n'.format(size=len(body))
+                        n = _buffered_write(stream, buf, n, size.encode())
+                    n = _buffered_write(stream, buf, n, body)
+                    if chunked:
+                        n = _buffered_write(stream, buf, n, b'\r\n')
+                    if n:
+                        stream.write(buf[:n])
+                        n = 0
+                    if can_flush:  # pragma: no cover
+                        stream.flush()
+                if chunked:
+                    n = _buffered_write(stream, buf, n, b'0\r\n\r\n')
+            if n:
+                stream.write(buf[:n])
+            if can_flush:  # pragma: no cover
+                stream.flush()
         except OSError as exc:  # pragma: no cover
             if exc.errno == 32:  # errno.EPIPE
                 pass
             else:
                 raise
 
+    def _write_file(self, stream, buf, n, chunked=False):
+        # read the file straight into the free part of the buffer, so that
+        # the first chunk goes out with the head and no chunk is copied. For
+        # chunked bodies room is left around the data for the chunk size,
+        # written with a fixed width, and the trailing CRLF
+        size = len(buf)
+        prefix = 8 if chunked else 0
+        suffix = 2 if chunked else 0
+        if size - n - prefix - suffix < 64:
+            stream.write(buf[:n])
+            n = 0
+        while True:
+            start = n + prefix
+            room = size - start - suffix
+            count = self.body.readinto(buf[start:start + room]) or 0
+            end = start + count
+            if chunked and count:
+                buf[n:start] = '{size:06x}\r\n'.format(size=count).encode()
+                buf[end:end + 2] = b'\r\n'
+                end += 2
+            elif not count:
+                end = n
+            if end:
+                stream.write(buf[:end])
+            if count < room:
+                break
+            n = 0
+        if chunked:
+            stream.write(b'0\r\n\r\n')
+        if hasattr(self.body, 'close'):  # pragma: no cover
+            self.body.close()
+        return 0
+
+    def _status_line(self):
+        key = (self.http_version, self.status_code, self.reason)
+        line = Response._status_lines.get(key)
+        if line is None:
+            reason = self.reason if self.reason is not None else \
+                ('OK' if self.status_code == 200 else 'N/A')
+            line = 'HTTP/{http_version} {status_code} {reason}\r\n'.format(
+                http_version=self.http_version, status_code=self.status_code,
+                reason=reason).encode()
+            if len(Response._status_lines) < 32:
+                Response._status_lines[key] = line
+        return line
+
+    def _connection_header(self):
+        if self.keep_alive is None:
+            return b''
+        return b'Connection: keep-alive\r\n' if self.keep_alive else \
+            b'Connection: close\r\n'
+
+    @staticmethod
+    def _write_buffer():
+        # one buffer per thread, in a dictionary keyed by thread id, as the
+        # threading module of MicroPython has no local(); a memoryview of it,
+        # so that writing out its first n bytes only allocates the slice
+        ident = get_ident()
+        buf = _write_buffers.get(ident)
+        if buf is None or len(buf) != Response.write_buffer_size:
+            if buf is None and len(_write_buffers) >= 16:
+                # threads started per connection leave their buffers behind
+                _write_buffers.clear()
+            buf = memoryview(bytearray(Response.write_buffer_size))
+            _write_buffers[ident] = buf
+        return buf
+
     def body_iter(self):
         if self.body:
             if hasattr(self.body, 'read'):
@@ -540,12 +724,183 @@ class Response():
         return cls(body=f, status_code=status_code,
                    headers={'Content-Type': content_type})
 
+    @classmethod
+    def event_stream(cls, events, retry=None):
+        """Return a server-sent events response, which a browser can read
+        with the ``EventSource`` class.
+
+        :param events: An iterable with the events to send, typically a
+                       generator. Each event is the data to send, given as a
+                       string, or as a dictionary or list that is sent as
+                       JSON. A ``(name, data)`` tuple sends a named event,
+                       and ``None`` sends a comment that keeps an idle
+                       connection open.
+        :param retry: The time in milliseconds the client should wait before
+                      reconnecting when the stream ends.
+
+        The events are sent with chunked encoding to HTTP/1.1 clients, so the
+        response can last as long as the generator does.
+
+        Example::
+
+            @app.route('/colour/stream')
+            def colour_stream(request):
+                def events():
+                    while True:
+                        red, green, blue = tcs.rgb
+                        yield {'red': red, 'green': green, 'blue': blue}
+                        time.sleep(0.5)
+
+                return Response.event_stream(events())
+        """
+        def stream():
+            if retry is not None:
+                yield 'retry: {retry}\n\n'.format(retry=retry).encode()
+            for event in events:
+                if event is None:
+                    yield b':\n\n'
+                    continue
+                name = None
+                if isinstance(event, tuple):
+                    name, event = event
+                if isinstance(event, (dict, list)):
+                    event = json.dumps(event)
+                elif isinstance(event, bytes):
+                    event = event.decode()
+                message = 'event: {name}\n'.format(name=name) if name else ''
+                for line in str(event).split('\n'):
+                    message += 'data: {line}\n'.format(line=line)
+                yield (message + '\n').encode()
+
+        return cls(body=stream(),
+                   headers={'Content-Type': 'text/event-stream',
+                            'Cache-Control': 'no-cache'})
+
+
+class CachedResponse(Response):
+    """A response written from the serialized copy of an earlier response.
+
+    :class:`ResponseCache` creates one of these lightweight objects for each
+    request that hits the cache. The status, headers and body are shared with
+    the cached copy, and only the status line and the ``Connection`` header
+    depend on the current request.
+    """
+    def __init__(self, entry):
+        self.entry = entry
+        self.status_code, self.reason, self.headers, self.body = entry[:4]
+
+    def complete(self):
+        pass
+
+    def write(self, stream):
+        buf = Response._write_buffer()
+        n = _buffered_write(stream, buf, 0, self._status_line())
+        n = _buffered_write(stream, buf, n, self.entry[4])
+        n = _buffered_write(stream, buf, n, self._connection_header())
+        n = _buffered_write(stream, buf, n, b'\r\n')
+        n = _buffered_write(stream, buf, n, self.body)
+        try:
+            if n:
+                stream.write(buf[:n])
+            if hasattr(stream, 'flush'):  # pragma: no cover
+                stream.flush()
+        except OSError as exc:  # pragma: no cover
+            if exc.errno == 32:  # errno.EPIPE
+                pass
+            else:
+                raise
+
+
+class ResponseCache():
+    """A cache of serialized responses, for routes registered with the
+    ``cache`` argument of :func:`Microdot.route`.
+
+    Responses are cached per route and URL, query string included, after
+    the after request handlers have run. Only ``200`` responses with a body
+    of bytes, strings or JSON are cached; streamed responses are always
+    generated.
+    """
+    #: The maximum number of URLs cached for each route.
+    max_entries = 32
+
+    #: The class used for the responses served from the cache.
+    response_class = CachedResponse
+
+    def __init__(self):
+        #: The cached routes, as a dictionary of handler functions to TTL
+        #: in seconds, or ``True`` for constant responses.
+        self.routes = {}
+        self.entries = {}
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, handler, req):
+        """Return a response for the request from the cache, or ``None`` if
+        it is not cached or has expired."""
+        entry = self.entries.get(handler, {}).get(self._key(req))
+        if entry is None or (entry[5] is not None and
+                             ticks_diff(entry[5], ticks_ms()) <= 0):
+            self.misses += 1
+            return None
+        self.hits += 1
+        return self.response_class(entry)
+
+    def put(self, handler, req, res):
+        """Store the response of a cached route."""
+        if res.status_code != 200 or not isinstance(res.body, bytes) or \
+                isinstance(res, CachedResponse):
+            return
+        res.complete()
+        headers = {}
+        head = b''
+        for header, value in res.headers.items():
+            if header == 'Connection':
+                continue
+            headers[header] = value
+            values = value if isinstance(value, list) else [value]
+            for value in values:
+                head += '{header}: {value}\r\n'.format(
+                    header=header, value=value).encode()
+        ttl = self.routes[handler]
+        expires = None if ttl is True else \
+            ticks_add(ticks_ms(), int(ttl * 1000))
+        urls = self.entries.setdefault(handler, {})
+        key = self._key(req)
+        if key in urls or len(urls) < self.max_entries:
+            urls[key] = (res.status_code, res.reason, headers, res.body,
+                         head, expires)
+
+    def clear(self):
+        """Remove all the cached responses."""
+        self.entries = {}
+
+    def stats(self):
+        """Return the cache counters, as a dictionary."""
+        return {
+            'routes': len(self.routes),
+            'entries': sum([len(urls) for urls in self.entries.values()]),
+            'hits': self.hits,
+            'misses': self.misses,
+        }
+
+    @staticmethod
+    def _key(req):
+        # the arguments of the query string can change the response
+        if req.query_string is None:
+            return req.path
+        return req.path + '?' + req.query_string
+
 
 class URLPattern():
     def __init__(self, url_pattern):
         self.url_pattern = url_pattern
         self.pattern = ''
         self.args = []
+        #: The parsed segments, as ``(type, value)`` tuples, where ``type`` is
+        #: ``None`` for static segments. Set to ``None`` when the pattern has
+        #: ``path`` or ``re:`` segments, which can only be matched with a
+        #: regular expression.
+        self.segments = []
         use_regex = False
         for segment in url_pattern.lstrip('/').split('/'):
             if segment and segment[0] == '<':
@@ -570,8 +925,15 @@ class URLPattern():
                 use_regex = True
                 self.pattern += '/({pattern})'.format(pattern=pattern)
                 self.args.append({'type': type_, 'name': name})
+                if self.segments is not None:
+                    if type_ in ('string', 'int'):
+                        self.segments.append((type_, name))
+                    else:
+                        self.segments = None
             else:
                 self.pattern += '/{segment}'.format(segment=segment)
+                if self.segments is not None:
+                    self.segments.append((None, segment))
         if use_regex:
             self.pattern = re.compile('^' + self.pattern + '$')
 
@@ -594,6 +956,118 @@ class URLPattern():
         return args
 
 
+class URLRouter():
+    """An index of the URL patterns registered with an application.
+
+    Patterns are stored in a prefix tree that is built when routes are
+    registered. Static segments are looked up in a dictionary and ``string``
+    and ``int`` segments are matched without regular expressions, so a path
+    is resolved in time proportional to its number of segments instead of the
+    number of routes. Patterns with ``path`` or ``re:`` segments are attached
+    to the node of their static prefix and only their regular expression is
+    evaluated when a path reaches that node.
+    """
+    class Node:
+        def __init__(self):
+            self.static = {}
+            self.int = None
+            self.string = None
+            self.routes = []
+            self.regex_routes = []
+
+    def __init__(self):
+        self.root = URLRouter.Node()
+        self.count = 0
+
+    def add(self, methods, pattern, handler):
+        """Add a route to the index.
+
+        :param methods: The list of HTTP methods handled by the route.
+        :param pattern: The :class:`URLPattern` of the route.
+        :param handler: The handler function.
+        """
+        route = [self.count, methods, handler, None]
+        self.count += 1
+        node = self.root
+        if pattern.segments is None:
+            for segment in pattern.url_pattern.lstrip('/').split('/')[:-1]:
+                if segment[:1] == '<':
+                    break
+                child = node.static.get(segment)
+                if child is None:
+                    child = node.static[segment] = URLRouter.Node()
+                node = child
+            route[3] = pattern
+            node.regex_routes.append(route)
+            return
+        args = []
+        for type_, value in pattern.segments:
+            if type_ is None:
+                child = node.static.get(value)
+                if child is None:
+                    child = node.static[value] = URLRouter.Node()
+            elif type_ == 'int':
+                child = node.int = node.int or URLRouter.Node()
+                args.append((value, int))
+            else:
+                child = node.string = node.string or URLRouter.Node()
+                args.append((value, None))
+            node = child
+        route[3] = args
+        node.routes.append(route)
+
+    def match(self, method, path):
+        """Find the handler for a request.
+
+        :param method: The HTTP method of the request.
+        :param path: The path portion of the URL.
+
+        The return value is a tuple with the handler and its URL arguments.
+        When no route matches the path the handler is 404, and when routes
+        match the path but not the method it is 405. As with a linear scan
+        of the URL map, the route registered first wins.
+        """
+        found = []
+        if path[:1] == '/':
+            self._walk(self.root, path, path[1:].split('/'), 0, [], found)
+        f = 404
+        best = None
+        for route, values in found:
+            if method not in route[1]:
+                f = 405
+            elif best is None or route[0] < best[0][0]:
+                best = (route, values)
+        if best is None:
+            return f, None
+        route, values = best
+        if isinstance(values, dict):
+            return route[2], values
+        url_args = {}
+        for (name, type_), value in zip(route[3], values):
+            url_args[name] = type_(value) if type_ else value
+        return route[2], url_args
+
+    def _walk(self, node, path, segments, i, values, found):
+        for route in node.regex_routes:
+            url_args = route[3].match(path)
+            if url_args is not None:
+                found.append((route, url_args))
+        if i == len(segments):
+            for route in node.routes:
+                found.append((route, values))
+            return
+        segment = segments[i]
+        child = node.static.get(segment)
+        if child is not None:
+            self._walk(child, path, segments, i + 1, values, found)
+        if node.int is not None and segment.isdigit():
+            self._walk(node.int, path, segments, i + 1, values + [segment],
+                       found)
+        if node.string is not None and segment:
+            self._walk(node.string, path, segments, i + 1,
+                       values + [segment], found)
+
+
 class HTTPException(Exception):
     def __init__(self, status_code, reason=None):
         self.status_code = status_code
@@ -603,6 +1077,113 @@ class HTTPException(Exception):
         return 'HTTPException: {}'.format(self.status_code)
 
 
+class WorkerPool():
+    """A fixed-size pool of threads that serve accepted connections from a
+    bounded queue.
+
+    :param handler: The function that serves a connection. It is called with
+                    the arguments given to :func:`submit`.
+    :param workers: The number of worker threads.
+    :param queue_size: The number of connections that can wait for a free
+                       worker. :func:`submit` refuses connections once the
+                       queue is full.
+
+    The pool only uses the locks of the ``_thread`` module, as the
+    ``threading`` module of MicroPython has no ``Condition``. An idle worker
+    waits on a lock of its own, which :func:`submit` releases to wake it up.
+    """
+    def __init__(self, handler, workers=4, queue_size=16):
+        self.handler = handler
+        self.workers = workers
+        self.queue_size = queue_size
+        self.queue = []
+        self.lock = allocate_lock()
+        self.idle = []  # the wake up locks of the waiting workers, held
+        self.closed = False
+        self.busy = 0
+        self.max_queue_depth = 0
+        self.accepted = 0
+        self.rejected = 0
+        self.completed = 0
+        self.wait_ms = 0
+        self.service_ms = 0
+        for _ in range(workers):
+            create_thread(self._worker)
+
+    def submit(self, *args):
+        """Queue a connection for the next free worker. Returns ``False``
+        when the queue is full, so that the caller can reject it."""
+        with self.lock:
+            if len(self.queue) >= self.queue_size:
+                self.rejected += 1
+                return False
+            self.queue.append((ticks_ms(), args))
+            self.accepted += 1
+            self.max_queue_depth = max(self.max_queue_depth, len(self.queue))
+            if self.idle:
+                self.idle.pop().release()
+        return True
+
+    def saturated(self):
+        """Return ``True`` when connections wait in the queue or every
+        worker is busy, so that a worker should not be held by an idle
+        keep-alive connection."""
+        with self.lock:
+            return bool(self.queue) or self.busy >= self.workers
+
+    def close(self):
+        """Stop the workers once the queued connections are served."""
+        with self.lock:
+            self.closed = True
+            while self.idle:
+                self.idle.pop().release()
+
+    def stats(self):
+        """Return the pool counters, as a dictionary. Latencies are averages
+        in milliseconds over the completed connections."""
+        with self.lock:
+            completed = self.completed or 1
+            return {
+                'workers': self.workers,
+                'busy': self.busy,
+                'queue_depth': len(self.queue),
+                'max_queue_depth': self.max_queue_depth,
+                'accepted': self.accepted,
+                'rejected': self.rejected,
+                'completed': self.completed,
+                'avg_wait_ms': self.wait_ms / completed,
+                'avg_service_ms': self.service_ms / completed,
+            }
+
+    def _worker(self):
+        wake_up = allocate_lock()
+        wake_up.acquire()
+        while True:
+            with self.lock:
+                if self.queue:
+                    queued, args = self.queue.pop(0)
+                    self.busy += 1
+                elif self.closed:
+                    return
+                else:
+                    queued = None
+                    self.idle.append(wake_up)
+            if queued is None:
+                # blocks until submit() or close() releases the lock
+                wake_up.acquire()
+                continue
+            start = ticks_ms()
+            try:
+                self.handler(*args)
+            except Exception as exc:  # pragma: no cover
+                print_exception(exc)
+            with self.lock:
+                self.busy -= 1
+                self.completed += 1
+                self.wait_ms += ticks_diff(start, queued)
+                self.service_ms += ticks_diff(ticks_ms(), start)
+
+
 class Microdot():
     """An HTTP application class.
 
@@ -617,16 +1198,38 @@ class Microdot():
         app = Microdot()
     """
 
+    #: The number of seconds a persistent connection is kept open while
+    #: waiting for the next request. Without threads the server closes the
+    #: connection after every response instead, as it cannot accept other
+    #: connections while it waits, and so does a worker of the pool when
+    #: connections are queued or all the workers are busy.
+    #:
+    #: Example::
+    #:
+    #:    Microdot.keep_alive_timeout = 2
+    keep_alive_timeout = 5
+
+    #: The maximum number of requests served over a single connection. Set to
+    #: 1 to close the connection after every response.
+    #:
+    #: Example::
+    #:
+    #:    Microdot.max_keep_alive_requests = 1  # disable keep-alive
+    max_keep_alive_requests = 100
+
     def __init__(self):
         self.url_map = []
+        self.router = URLRouter()
+        self.response_cache = ResponseCache()
         self.before_request_handlers = []
         self.after_request_handlers = []
         self.error_handlers = {}
         self.shutdown_requested = False
         self.debug = False
         self.server = None
+        self.pool = None
 
-    def route(self, url_pattern, methods=None):
+    def route(self, url_pattern, methods=None, cache=None):
         """Decorator that is used to register a function as a request handler
         for a given URL.
 
@@ -635,6 +1238,13 @@ class Microdot():
         :param methods: The list of HTTP methods to be handled by the
                         decorated function. If omitted, only ``GET`` requests
                         are handled.
+        :param cache: ``True`` to serialize the first response of the route
+                      and serve those bytes to all later requests for the
+                      same URL, query string included, or a number of
+                      seconds to serve them for before calling the handler
+                      again. Only use it for handlers without side effects.
+                      The hit and miss counters are returned by
+                      ``response_cache.stats()``.
 
         The URL pattern can be a static path (for example, ``/users`` or
         ``/api/invoices/search``) or a path with dynamic components enclosed
@@ -657,17 +1267,20 @@ class Microdot():
                 return 'Hello, world!'
         """
         def decorated(f):
-            self.url_map.append(
-                (methods or ['GET'], URLPattern(url_pattern), f))
+            self._add_route(methods or ['GET'], URLPattern(url_pattern), f)
+            if cache:
+                self.response_cache.routes[f] = cache
             return f
         return decorated
 
-    def get(self, url_pattern):
+    def get(self, url_pattern, cache=None):
         """Decorator that is used to register a function as a ``GET`` request
         handler for a given URL.
 
         :param url_pattern: The URL pattern that will be compared against
                             incoming requests.
+        :param cache: Cache the responses of the route, as described in
+                      :func:`route`.
 
         This decorator can be used as an alias to the ``route`` decorator with
         ``methods=['GET']``.
@@ -678,7 +1291,7 @@ class Microdot():
             def get_user(request, id):
                 # ...
         """
-        return self.route(url_pattern, methods=['GET'])
+        return self.route(url_pattern, methods=['GET'], cache=cache)
 
     def post(self, url_pattern):
         """Decorator that is used to register a function as a ``POST`` request
@@ -815,15 +1428,17 @@ class Microdot():
         :param url_prefix: The URL prefix to mount the application under.
         """
         for methods, pattern, handler in subapp.url_map:
-            self.url_map.append(
-                (methods, URLPattern(url_prefix + pattern.url_pattern),
-                 handler))
+            self._add_route(
+                methods, URLPattern(url_prefix + pattern.url_pattern),
+                handler)
         for handler in subapp.before_request_handlers:
             self.before_request_handlers.append(handler)
         for handler in subapp.after_request_handlers:
             self.after_request_handlers.append(handler)
         for status_code, handler in subapp.error_handlers.items():
             self.error_handlers[status_code] = handler
+        for handler, ttl in subapp.response_cache.routes.items():
+            self.response_cache.routes[handler] = ttl
 
     @staticmethod
     def abort(status_code, reason=None):
@@ -847,7 +1462,8 @@ class Microdot():
         """
         raise HTTPException(status_code, reason)
 
-    def run(self, host='0.0.0.0', port=5000, debug=False):
+    def run(self, host='0.0.0.0', port=5000, debug=False, workers=4,
+            queue_size=16, retry_after=1):
         """Start the web server. This function does not normally return, as
         the server enters an endless listening loop. The :func:`shutdown`
         function provides a method for terminating the server gracefully.
@@ -863,6 +1479,17 @@ class Microdot():
                      port 5000.
         :param debug: If ``True``, the server logs debugging information. The
                       default is ``False``.
+        :param workers: The number of threads that serve connections. Set to
+                        0 to start a new thread for every connection. This
+                        argument is ignored when threads are not available.
+        :param queue_size: The number of accepted connections that can wait
+                           for a free worker. When the queue is full new
+                           connections receive a 503 response.
+        :param retry_after: The value of the ``Retry-After`` header, in
+                            seconds, sent with 503 responses.
+
+        While the server runs, :attr:`pool` holds the :class:`WorkerPool`,
+        whose ``stats()`` method reports the queue depth and latencies.
 
         Example::
 
@@ -890,15 +1517,24 @@ class Microdot():
         self.server.bind(addr)
         self.server.listen(5)
 
-        while not self.shutdown_requested:
-            try:
-                sock, addr = self.server.accept()
-            except OSError as exc:  # pragma: no cover
-                if exc.errno == errno.ECONNABORTED:
-                    break
-                else:
-                    raise
-            create_thread(self.handle_request, sock, addr)
+        if concurrency_mode == 'threaded' and workers:
+            self.pool = WorkerPool(self.handle_request, workers, queue_size)
+        try:
+            while not self.shutdown_requested:
+                try:
+                    sock, addr = self.server.accept()
+                except OSError as exc:  # pragma: no cover
+                    if exc.errno == errno.ECONNABORTED:
+                        break
+                    else:
+                        raise
+                if self.pool is None:
+                    create_thread(self.handle_request, sock, addr)
+                elif not self.pool.submit(sock, addr):
+                    self._reject(sock, retry_after)
+        finally:
+            if self.pool is not None:
+                self.pool.close()
 
     def shutdown(self):
         """Request a server shutdown. The server will then exit its request
@@ -916,30 +1552,47 @@ class Microdot():
         self.shutdown_requested = True
 
     def find_route(self, req):
-        f = 404
-        for route_methods, route_pattern, route_handler in self.url_map:
-            req.url_args = route_pattern.match(req.path)
-            if req.url_args is not None:
-                if req.method in route_methods:
-                    f = route_handler
-                    break
-                else:
-                    f = 405
+        f, req.url_args = self.router.match(req.method, req.path)
         return f
 
+    def _add_route(self, methods, pattern, handler):
+        self.url_map.append((methods, pattern, handler))
+        self.router.add(methods, pattern, handler)
+
     def handle_request(self, sock, addr):
         if not hasattr(sock, 'readline'):  # pragma: no cover
             stream = sock.makefile("rwb")
         else:
             stream = sock
 
-        req = None
-        try:
-            req = Request.create(self, stream, addr)
-        except Exception as exc:  # pragma: no cover
-            print_exception(exc)
-        res = self.dispatch_request(req)
-        res.write(stream)
+        served = 0
+        keep_alive = True
+        while keep_alive:
+            req = None
+            try:
+                if served:
+                    sock.settimeout(self.keep_alive_timeout)
+                req = Request.create(self, stream, addr)
+                if served:
+                    if req is None:
+                        break
+                    sock.settimeout(None)
+            except Exception as exc:  # pragma: no cover
+                if served and isinstance(exc, OSError):
+                    # idle timeout, or the client went away
+                    break
+                print_exception(exc)
+            served += 1
+            res = self.dispatch_request(req)
+            keep_alive = self._keep_alive(req, res, served,
+                                          concurrency_mode != 'sync')
+            res.write(stream)
+            if hasattr(stream, 'flush'):  # pragma: no cover
+                stream.flush()
+            if self.debug and req:  # pragma: no cover
+                print('{method} {path} {status_code}'.format(
+                    method=req.method, path=req.path,
+                    status_code=res.status_code))
         try:
             stream.close()
         except OSError as exc:  # pragma: no cover
@@ -951,10 +1604,59 @@ class Microdot():
             sock.close()
         if self.shutdown_requested:  # pragma: no cover
             self.server.close()
-        if self.debug and req:  # pragma: no cover
-            print('{method} {path} {status_code}'.format(
-                method=req.method, path=req.path,
-                status_code=res.status_code))
+
+    def _reject(self, sock, retry_after):
+        if not hasattr(sock, 'readline'):  # pragma: no cover
+            stream = sock.makefile("rwb")
+        else:
+            stream = sock
+        res = Response('Service unavailable', 503,
+                       {'Retry-After': str(retry_after),
+                        'Connection': 'close'},
+                       reason='Service Unavailable')
+        try:
+            # read the request head first, as closing a socket with unread
+            # data resets the connection before the client sees the 503
+            sock.settimeout(0.2)
+            Request.create(self, stream, None)
+        except Exception:  # pragma: no cover
+            pass
+        try:
+            res.write(stream)
+            stream.close()
+        except OSError as exc:  # pragma: no cover
+            if exc.args[0] not in MUTED_SOCKET_ERRORS:
+                print_exception(exc)
+        if stream != sock:  # pragma: no cover
+            sock.close()
+
+    def _keep_alive(self, req, res, served, allowed=True):
+        keep_alive = False
+        if self.pool is not None and self.pool.saturated():
+            # waiting for the next request would keep the worker from the
+            # connections queued behind this one
+            allowed = False
+        if req:
+            if req.http_version == '1.1':
+                res.http_version = '1.1'
+            if allowed and req.keep_alive and not self.shutdown_requested and \
+                    served < self.max_keep_alive_requests and \
+                    res.headers.get('Connection', '').lower() != 'close':
+                res.complete()
+                # responses must be Content-Length framed, and the request
+                # payload fully consumed, before another request is read
+                if ('Content-Length' in res.headers or res.headers.get(
+                        'Transfer-Encoding') == 'chunked') \
+                        and not req.stream_used \
+                        and req.content_length <= req.max_content_length \
+                        and req.content_length <= req.max_body_length:
+                    try:
+                        req.body
+                        keep_alive = True
+                    except Exception:  # pragma: no cover
+                        pass
+        res.keep_alive = keep_alive
+        return keep_alive
 
     def dispatch_request(self, req):
         if req:
@@ -967,11 +1669,17 @@ class Microdot():
                 f = self.find_route(req)
                 try:
                     res = None
+                    cached = False
                     if callable(f):
                         for handler in self.before_request_handlers:
                             res = handler(req)
                             if res:
                                 break
+                        if res is None and f in self.response_cache.routes:
+                            res = self.response_cache.get(f, req)
+                            if res is not None:
+                                return res
+                            cached = True
                         if res is None:
                             res = f(req, **req.url_args)
                         if isinstance(res, tuple):
@@ -989,6 +1697,8 @@ class Microdot():
                             res = handler(req, res) or res
                         for handler in req.after_request_handlers:
                             res = handler(req, res) or res
+                        if cached:
+                            self.response_cache.put(f, req, res)
                     elif f in self.error_handlers:
                         res = self.error_handlers[f](req)
                     else:
@@ -1027,4 +1737,5 @@ class Microdot():
 
 abort = Microdot.abort
 redirect = Response.redirect
-send_file = Response.send_file
\ No newline at end of file
+send_file = Response.send_file
+event_stream = Response.event_stream
@@ -0,0 +1,367 @@
+"""
+microdot_asyncio
+----------------
+
+The ``microdot_asyncio`` module defines a few classes that help implement
+HTTP-based servers for MicroPython and standard Python that use ``asyncio``
+and coroutines. All the connections are served from a single thread, so
+handlers that wait on I/O should be written as ``async def`` functions. Plain
+functions are also accepted, and run to completion on the event loop.
+"""
+try:
+    import uasyncio as asyncio
+except ImportError:
+    import asyncio
+
+from microdot import Microdot as BaseMicrodot
+from microdot import print_exception
+from microdot import Request as BaseRequest
+from microdot import Response as BaseResponse
+from microdot import CachedResponse as BaseCachedResponse
+from microdot import HTTPException
+from microdot import MUTED_SOCKET_ERRORS
+
+
+def _iscoroutine(coro):
+    return hasattr(coro, 'send') and hasattr(coro, 'throw')
+
+
+class Request(BaseRequest):
+    @staticmethod
+    async def create(app, client_stream, client_addr):
+        """Create a request object.
+
+        :param app: The Microdot application instance.
+        :param client_stream: An asyncio stream from where the request data
+                              can be read.
+        :param client_addr: The address of the client, as a tuple.
+
+        This method is a coroutine. It returns a newly created ``Request``
+        object, with the body already read when it is no larger than
+        ``max_body_length``.
+        """
+        # request line
+        line = (await Request._safe_readline(client_stream)).strip().decode()
+        if not line:
+            return None
+        method, url, http_version = line.split()
+        http_version = http_version.split('/', 1)[1]
+
+        # headers
+        headers = {}
+        content_length = 0
+        while True:
+            line = (await Request._safe_readline(
+                client_stream)).strip().decode()
+            if line == '':
+                break
+            header, value = Request._split_header(line)
+            headers[header] = value
+            if header.lower() == 'content-length':
+                content_length = int(value)
+
+        # body
+        body = None
+        if content_length and content_length <= Request.max_body_length:
+            body = await client_stream.readexactly(content_length)
+
+        return Request(app, client_addr, method, url, http_version, headers,
+                       body=body, stream=client_stream)
+
+    @staticmethod
+    async def _safe_readline(stream):
+        line = await stream.readline()
+        if len(line) > Request.max_readline:
+            raise ValueError('line too long')
+        return line
+
+
+class Response(BaseResponse):
+    """An HTTP response class for the asyncio server.
+
+    The arguments are the same as for :class:`microdot.Response`.
+    """
+    async def write(self, stream):
+        self.complete()
+
+        try:
+            # status code
+            reason = self.reason if self.reason is not None else \
+                ('OK' if self.status_code == 200 else 'N/A')
+            stream.write('HTTP/{http_version} {status_code} {reason}\r\n'
+                         .format(http_version=self.http_version,
+                                 status_code=self.status_code,
+                                 reason=reason).encode())
+
+            # headers
+            for header, value in self.headers.items():
+                if header == 'Connection' and self.keep_alive is not None:
+                    continue
+                values = value if isinstance(value, list) else [value]
+                for value in values:
+                    stream.write('{header}: {value}\r\n'.format(
+                        header=header, value=value).encode())
+            stream.write(self._connection_header())
+            stream.write(b'\r\n')
+
+            # body
+            chunked = self.headers.get('Transfer-Encoding') == 'chunked'
+            for body in self.body_iter():
+                if isinstance(body, str):  # pragma: no cover
+                    body = body.encode()
+                if chunked:
+                    if not body:
+                        # an empty chunk would end the body
+                        continue
+                    stream.write('{size:x}\r\n'.format(
+                        size=len(body)).encode())
+                    stream.write(body)
+                    stream.write(b'\r\n')
+                else:
+                    stream.write(body)
+                await stream.drain()
+            if chunked:
+                stream.write(b'0\r\n\r\n')
+            await stream.drain()
+        except OSError as exc:  # pragma: no cover
+            if exc.args[0] in MUTED_SOCKET_ERRORS:
+                pass
+            else:
+                raise
+
+
+class CachedResponse(BaseCachedResponse):
+    """A response written from the serialized copy of an earlier response,
+    for the asyncio server."""
+    async def write(self, stream):
+        try:
+            stream.write(self._status_line())
+            stream.write(self.entry[4])
+            stream.write(self._connection_header())
+            stream.write(b'\r\n')
+            stream.write(self.body)
+            await stream.drain()
+        except OSError as exc:  # pragma: no cover
+            if exc.args[0] in MUTED_SOCKET_ERRORS:
+                pass
+            else:
+                raise
+
+
+class Microdot(BaseMicrodot):
+    """An HTTP application class served by an ``asyncio`` event loop.
+
+    Route handlers, before and after request handlers and error handlers can
+    be coroutines or plain functions.
+
+    Example::
+
+        from microdot_asyncio import Microdot
+
+        app = Microdot()
+
+        @app.route('/')
+        async def index(request):
+            return 'Hello, world!'
+
+        app.run()
+    """
+    def __init__(self):
+        super().__init__()
+        self.response_cache.response_class = CachedResponse
+
+    async def start_server(self, host='0.0.0.0', port=5000, debug=False):
+        """Start the asyncio web server. This coroutine does not normally
+        return, as the server enters an endless listening loop. The
+        :func:`shutdown` function provides a method for terminating the
+        server gracefully.
+
+        The arguments are the same as for :func:`run`. This method can be used
+        instead of :func:`run` to start the server as a task in an
+        application that runs other coroutines, such as a sensor sampler.
+
+        Example::
+
+            import asyncio
+            from microdot_asyncio import Microdot
+
+            app = Microdot()
+
+            @app.route('/')
+            async def index(request):
+                return 'Hello, world!'
+
+            async def main():
+                await app.start_server(debug=True)
+
+            asyncio.run(main())
+        """
+        self.debug = debug
+        self.shutdown_requested = False
+
+        async def serve(reader, writer):
+            await self.handle_request(reader, writer)
+
+        if self.debug:  # pragma: no cover
+            print('Starting async server on {host}:{port}...'.format(
+                host=host, port=port))
+
+        self.server = await asyncio.start_server(serve, host, port)
+        while True:
+            try:
+                await self.server.wait_closed()
+                break
+            except AttributeError:  # pragma: no cover
+                # the task hasn't been initialized in the server object yet
+                # wait a bit and try again
+                await asyncio.sleep(0.1)
+
+    def run(self, host='0.0.0.0', port=5000, debug=False):
+        """Start the web server. This function does not normally return, as
+        the server enters an endless listening loop. The :func:`shutdown`
+        function provides a method for terminating the server gracefully.
+
+        The arguments are the same as for :func:`microdot.Microdot.run`.
+        """
+        asyncio.run(self.start_server(host=host, port=port, debug=debug))
+
+    def shutdown(self):
+        """Request a server shutdown. The server stops accepting connections
+        and the :func:`run` function returns."""
+        self.shutdown_requested = True
+        self.server.close()
+
+    async def handle_request(self, reader, writer):
+        addr = writer.get_extra_info('peername')
+        served = 0
+        keep_alive = True
+        while keep_alive:
+            req = None
+            try:
+                if served:
+                    req = await asyncio.wait_for(
+                        Request.create(self, reader, addr),
+                        self.keep_alive_timeout)
+                    if req is None:
+                        break
+                else:
+                    req = await Request.create(self, reader, addr)
+            except Exception as exc:  # pragma: no cover
+                if served and isinstance(exc, (OSError,
+                                               asyncio.TimeoutError)):
+                    # idle timeout, or the client went away
+                    break
+                print_exception(exc)
+            served += 1
+            res = await self.dispatch_request(req)
+            keep_alive = self._keep_alive(req, res, served)
+            await res.write(writer)
+            if self.debug and req:  # pragma: no cover
+                print('{method} {path} {status_code}'.format(
+                    method=req.method, path=req.path,
+                    status_code=res.status_code))
+        try:
+            writer.close()
+            await writer.wait_closed()
+        except OSError as exc:  # pragma: no cover
+            if exc.args[0] in MUTED_SOCKET_ERRORS:
+                pass
+            else:
+                raise
+
+    async def dispatch_request(self, req):
+        if req:
+            if req.content_length > req.max_content_length:
+                if 413 in self.error_handlers:
+                    res = await self._invoke_handler(
+                        self.error_handlers[413], req)
+                else:
+                    res = 'Payload too large', 413
+            else:
+                f = self.find_route(req)
+                try:
+                    res = None
+                    cached = False
+                    if callable(f):
+                        for handler in self.before_request_handlers:
+                            res = await self._invoke_handler(handler, req)
+                            if res:
+                                break
+                        if res is None and f in self.response_cache.routes:
+                            res = self.response_cache.get(f, req)
+                            if res is not None:
+                                return res
+                            cached = True
+                        if res is None:
+                            res = await self._invoke_handler(
+                                f, req, **req.url_args)
+                        if isinstance(res, tuple):
+                            body = res[0]
+                            if isinstance(res[1], int):
+                                status_code = res[1]
+                                headers = res[2] if len(res) > 2 else {}
+                            else:
+                                status_code = 200
+                                headers = res[1]
+                            res = Response(body, status_code, headers)
+                        elif not isinstance(res, Response):
+                            res = Response(res)
+                        for handler in self.after_request_handlers:
+                            res = await self._invoke_handler(
+                                handler, req, res) or res
+                        for handler in req.after_request_handlers:
+                            res = await self._invoke_handler(
+                                handler, req, res) or res
+                        if cached:
+                            self.response_cache.put(f, req, res)
+                    elif f in self.error_handlers:
+                        res = await self._invoke_handler(
+                            self.error_handlers[f], req)
+                    else:
+                        res = 'Not found', f
+                except HTTPException as exc:
+                    print_exception(exc)
+                    if exc.status_code in self.error_handlers:
+                        res = await self._invoke_handler(
+                            self.error_handlers[exc.status_code], req)
+                    else:
+                        res = exc.reason, exc.status_code
+                except Exception as exc:
+                    print_exception(exc)
+                    res = None
+                    if exc.__class__ in self.error_handlers:
+                        try:
+                            res = await self._invoke_handler(
+                                self.error_handlers[exc.__class__], req, exc)
+                        except Exception as exc2:  # pragma: no cover
+                            print_exception(exc2)
+                    if res is None:
+                        if 500 in self.error_handlers:
+                            res = await self._invoke_handler(
+                                self.error_handlers[500], req)
+                        else:
+                            res = 'Internal server error', 500
+        else:
+            if 400 in self.error_handlers:
+                res = await self._invoke_handler(self.error_handlers[400], req)
+            else:
+                res = 'Bad request', 400
+
+        if isinstance(res, tuple):
+            res = Response(*res)
+        elif not isinstance(res, Response):
+            res = Response(res)
+        return res
+
+    async def _invoke_handler(self, f_or_coro, *args, **kwargs):
+        ret = f_or_coro(*args, **kwargs)
+        if _iscoroutine(ret):
+            ret = await ret
+        return ret
+
+
+abort = Microdot.abort
+redirect = Response.redirect
+send_file = Response.send_file
+event_stream = Response.event_stream
+
@@ -0,0 +1,251 @@
+# motion.py
+
+# acceleration limited motion profiles for the stepper drivers
+
+# a Profile plans a move of a number of steps at up to a number of steps per
+# second, and returns a Move with the interval, in microseconds, between each
+# step and the next one: a ramp up from start_sps, a cruise at constant speed
+# and a ramp down to start_sps
+
+# the ramps are precomputed tables (array of unsigned 16 bit microseconds),
+# the cruise is a single value, so a move of 700000 steps does not need a
+# 700000 entry table
+
+# this module does not use machine, so the profiles can be simulated offline:
+#   python3 motion.py steps sps [accel] [curve]
+
+# -----------------------------------------------
+# imports
+# -----------------------------------------------
+
+from array import array
+import math
+
+# -----------------------------------------------
+# profiles
+# -----------------------------------------------
+
+TRAPEZOID = 'trapezoid'  # constant acceleration
+SCURVE = 's-curve'  # smooth-step speed, no acceleration jumps at the ends
+
+
+class Move:
+    # the intervals of a planned move, a move of n steps has n - 1 intervals
+
+    def __init__(self, steps, up, n_up, cruise, down, n_down):
+        self.steps = steps
+        self.up = up  # ramp up intervals, from the first step
+        self.n_up = n_up
+        self.cruise = cruise  # interval at full speed
+        self.down = down  # ramp down intervals, from the last step
+        self.n_down = n_down
+        self.decel_from = steps - 1 - n_down if n_down else steps
+
+    def interval(self, i):
+        # microseconds from step i to step i + 1 (for the last step, the
+        # value is not used)
+        if i < self.n_up:
+            return self.up[i]
+        if i >= self.decel_from:
+            return self.down[self.steps - 2 - i]
+        return self.cruise
+
+    def duration_us(self, start=0):
+        # microseconds from step `start` to the last step
+        gaps = max(self.steps - 1, 0)
+        if start >= gaps:
+            return 0
+        down_from = gaps - self.n_down
+        total = 0
+        if start < self.n_up:
+            total += sum(self.up[start:self.n_up])
+        cruise_from = max(start, self.n_up)
+        if cruise_from < down_from:
+            total += self.cruise * (down_from - cruise_from)
+        total += sum(self.down[:gaps - max(start, down_from)])
+        return total
+
+
+class Profile:
+
+    def __init__(self,
+                 accel=10000,  # acceleration, steps/s^2
+                 decel=None,  # deceleration, steps/s^2 (default accel)
+                 max_sps=None,  # max steps-per-second, None for no limit
+                 start_sps=200,  # speed the ramps start and end at
+                 curve=TRAPEZOID,  # TRAPEZOID or SCURVE
+                 max_ramp=4000  # max steps in a ramp table (memory limit)
+                 ):
+        self.accel = accel
+        self.decel = decel or accel
+        self.max_sps = max_sps
+        # intervals are 16 bit, so at least 16 steps-per-second
+        self.start_sps = max(start_sps, 16)
+        self.curve = curve
+        # the s-curve peaks at 1.5 times its mean acceleration, so it is
+        # stretched to keep the peak within accel, and covers 1.5 times the
+        # distance of a trapezoid ramp
+        self.k = 1.5 if curve == SCURVE else 1
+        self.max_ramp = max_ramp
+        self.tables = {}  # (speed, accel) -> ramp table
+
+    def ramp_steps(self, sps, accel):
+        v0 = self.start_sps
+        return int(self.k * (sps * sps - v0 * v0) / (2 * accel))
+
+    def peak_sps(self, steps, sps):
+        # fastest speed a move of `steps` steps can reach
+        v0 = self.start_sps
+        if self.max_sps:
+            sps = min(sps, self.max_sps)
+        if sps <= v0:
+            return sps
+        # ramps up and down meet in the middle
+        v2 = v0 * v0 + 2 * steps / (self.k * (1 / self.accel + 1 / self.decel))
+        # ramps fit in their tables
+        v2 = min(v2, v0 * v0 + 2 * self.max_ramp * min(self.accel, self.decel)
+                 / self.k)
+        return min(sps, int(math.sqrt(v2)))
+
+    def ramp(self, sps, accel):
+        # intervals of a ramp from start_sps to sps, cached
+        key = (sps, accel)
+        table = self.tables.get(key)
+        if table is None:
+            if len(self.tables) >= 8:
+                self.tables.clear()
+            table = self.tables[key] = array('H', self._intervals(sps, accel))
+        return table
+
+    def _intervals(self, sps, accel):
+        # times of each step rounded to whole microseconds, so the rounding
+        # error does not accumulate over the ramp
+        v0 = self.start_sps
+        n = self.ramp_steps(sps, accel)
+        last = 0
+        t = 0.0
+        if self.curve == SCURVE:
+            dv = sps - v0
+            T = self.k * dv / accel  # ramp duration
+            for i in range(1, n + 1):
+                # solve position(t) = i, newton from the previous step
+                t += 1 / (v0 + dv * _smooth(t / T))
+                for _ in range(4):
+                    x = min(t / T, 1)
+                    p = v0 * t + dv * T * (x * x * x - x * x * x * x / 2)
+                    t -= (p - i) / (v0 + dv * _smooth(x))
+                now = int(t * 1000000 + 0.5)
+                yield now - last
+                last = now
+        else:
+            for i in range(1, n + 1):
+                t = (math.sqrt(v0 * v0 + 2 * accel * i) - v0) / accel
+                now = int(t * 1000000 + 0.5)
+                yield now - last
+                last = now
+
+    def plan(self, steps, sps):
+        steps = abs(steps)
+        vp = self.peak_sps(steps, sps)
+        cruise = int(round(1000000 / max(1, vp), 0))
+        if vp <= self.start_sps:
+            return Move(steps, (), 0, cruise, (), 0)
+        up = self.ramp(vp, self.accel)
+        down = self.ramp(vp, self.decel)
+        gaps = max(steps - 1, 0)
+        n_up = min(len(up), gaps)
+        n_down = min(len(down), gaps - n_up)
+        return Move(steps, up, n_up, cruise, down, n_down)
+
+
+def _smooth(x):
+    # smooth-step speed fraction, 3x^2 - 2x^3
+    return x * x * (3 - 2 * x)
+
+
+# -----------------------------------------------
+# offline simulator
+# -----------------------------------------------
+
+def simulate(profile, steps, sps):
+    # report the duration of a move and the jitter of its intervals: how far
+    # they are from the exact profile after rounding to microseconds, and the
+    # largest change of speed between two consecutive steps
+    move = profile.plan(steps, sps)
+    duration = 0
+    prev = None
+    max_change = 0
+    for i in range(move.steps - 1):
+        interval = move.interval(i)
+        duration += interval
+        if prev is not None:
+            max_change = max(max_change, abs(interval - prev) / prev)
+        prev = interval
+
+    # exact profile, to measure the rounding error
+    v0 = profile.start_sps
+    vp = profile.peak_sps(steps, sps)
+    errors = []
+    if vp > v0:
+        exact = _exact_intervals(profile, vp, profile.accel, move.n_up)
+        for i in range(move.n_up):
+            errors.append(move.up[i] - exact[i])
+
+    report = {
+        'steps': move.steps,
+        'peak_sps': vp,
+        'ramp_up_steps': move.n_up,
+        'ramp_down_steps': move.n_down,
+        'duration_ms': duration / 1000,
+        'constant_sps_ms': move.steps * 1000 / sps,
+        'constant_start_sps_ms': move.steps * 1000 / v0,
+        'max_speed_change_pct': max_change * 100,
+        'max_rounding_us': max([abs(e) for e in errors] or [0]),
+        'rms_rounding_us': math.sqrt(sum([e * e for e in errors]) /
+                                     len(errors)) if errors else 0,
+    }
+    return report
+
+
+def _exact_intervals(profile, sps, accel, n):
+    # the ramp intervals without rounding the step times
+    v0 = profile.start_sps
+    times = [0.0]
+    if profile.curve == SCURVE:
+        dv = sps - v0
+        T = profile.k * dv / accel
+        t = 0.0
+        for i in range(1, n + 1):
+            lo, hi = t, T * 2
+            for _ in range(60):
+                t = (lo + hi) / 2
+                x = min(t / T, 1)
+                p = v0 * t + dv * T * (x ** 3 - x ** 4 / 2)
+                if p < i:
+                    lo = t
+                else:
+                    hi = t
+            times.append(t)
+    else:
+        for i in range(1, n + 1):
+            times.append((math.sqrt(v0 * v0 + 2 * accel * i) - v0) / accel)
+    return [(times[i + 1] - times[i]) * 1000000 for i in range(n)]
+
+
+if __name__ == '__main__':
+    import sys
+
+    args = sys.argv[1:]
+    steps = int(args[0]) if args else 700000
+    sps = int(args[1]) if len(args) > 1 else 5000
+    accel = int(args[2]) if len(args) > 2 else 10000
+    curves = [args[3]] if len(args) > 3 else [TRAPEZOID, SCURVE]
+    for curve in curves:
+        print(curve)
+        report = simulate(Profile(accel=accel, curve=curve), steps, sps)
+        for key, value in report.items():
+            print('  {0}: {1}'.format(key, value))
+
+# -----------------------------------------------
+# end
+# -----------------------------------------------
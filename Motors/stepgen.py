@@ -0,0 +1,378 @@
+# stepgen.py
+
+# step pulses generated from a one-shot timer instead of a busy-wait loop
+
+# a StepGenerator owns one tick source (a machine.Timer by default) and any
+# number of channels, one per step pin; the timer is armed for the next step
+# due on any channel, and its callback pulses the pins of the channels whose
+# step is due, then arms it again, so a move only costs one callback per
+# step and the thread that started it can sleep; nothing runs between the
+# steps, whatever the speed of the other axes
+
+# the intervals come from a motion.Move, planned before the move starts, and
+# the callback does not allocate: the methods it calls are bound in advance
+
+# the steps are timed from the clock of the first one, so the latency of a
+# callback does not accumulate along the move; the timer is never armed for
+# less than 1 / max_sps seconds, the generator cannot step a channel faster,
+# and the speeds above are clamped by its users (see controller.py)
+
+# a move can have followers, channels that step in the same callback as the
+# leading channel when a bresenham error term says so, for coordinated moves
+# of several axes in straight lines; the pins that step in a callback are
+# all set high before any of them is set low, so their pulses overlap
+
+# the generator also measures how far the real interval between two pulses
+# is from the planned one (timer latency, other interrupts and the steps of
+# the other channels), see stats()
+
+# to run without hardware, use ManualTicks and call tick() to advance time;
+# run this module to check the pulses of two channels at different speeds,
+# of a follower, and a move that ends while the schedule queue is full:
+#   python3 stepgen.py
+
+try:
+    from micropython import schedule
+except ImportError:
+    _scheduled = []
+
+    def schedule(function, arg):
+        # as micropython does, a function scheduled from a scheduled one
+        # runs after it, not inside
+        _scheduled.append((function, arg))
+        if len(_scheduled) == 1:
+            while _scheduled:
+                function, arg = _scheduled[0]
+                function(arg)
+                _scheduled.pop(0)
+
+# -----------------------------------------------
+# tick sources
+# -----------------------------------------------
+
+
+class TimerTicks:
+    # one-shot machine.Timer, its callback is scheduled (soft)
+
+    def __init__(self, timer_id=0):
+        import time
+        self.timer_id = timer_id
+        self.timer = None
+        self.clock = time.ticks_us
+        self.diff = time.ticks_diff
+        self.add = time.ticks_add
+
+    def start(self, us, callback):
+        # call back once, `us` microseconds from now
+        if self.timer is None:
+            from machine import Timer
+            self.timer = Timer(self.timer_id)
+            self.mode = Timer.ONE_SHOT
+        self.timer.init(mode=self.mode, period=us, tick_hz=1000000,
+                        callback=callback)
+
+    def stop(self):
+        if self.timer:
+            self.timer.deinit()
+
+
+class ManualTicks:
+    # ticks advanced by calling tick(), with a simulated microsecond clock,
+    # to run the generator offline
+
+    def __init__(self):
+        self.callback = None
+        self.now = 0
+        self.at = 0  # clock the timer is armed for
+
+    def clock(self):
+        return self.now
+
+    def diff(self, a, b):
+        return a - b
+
+    def add(self, a, b):
+        return a + b
+
+    def start(self, us, callback):
+        self.at = self.now + us
+        self.callback = callback
+
+    def stop(self):
+        self.callback = None
+
+    def tick(self, n=1, latency=None):
+        # run the clock to the next `n` callbacks
+        # latency: function of the callback number that returns extra
+        # microseconds of callback latency, to simulate jitter
+        for i in range(n):
+            if self.callback is None:
+                break
+            self.now = max(self.now, self.at)
+            if latency:
+                self.now += latency(i)
+            callback = self.callback
+            self.callback = None
+            schedule(callback, None)
+
+
+# -----------------------------------------------
+# generator
+# -----------------------------------------------
+
+class Channel:
+    # the state of one step pin
+
+    def __init__(self, pin):
+        self.pin = pin
+        self.set = pin.value  # bound once, used from the tick callback
+        self.interval = None  # planned intervals, Move.interval
+        self.steps = 0  # steps in the move
+        self.index = 0  # steps done
+        self.time = 0  # clock of the next step
+        self.expected = 0  # planned interval before the next step
+        self.last = 0  # clock of the last step
+        self.leader = None  # channel this one follows during a move
+        self.followers = ()  # channels following this one
+        self.error = 0  # bresenham error term, when following
+        self.done = None  # called, scheduled, when a leading move ends
+        self.ended = False  # done still to be scheduled
+
+    @property
+    def running(self):
+        return self.index < self.steps
+
+
+class StepGenerator:
+
+    def __init__(self,
+                 ticks=None,  # tick source, TimerTicks() by default
+                 max_sps=20000  # the most steps-per-second of a channel
+                 ):
+        self.ticks = ticks or TimerTicks()
+        self.max_sps = max_sps
+        # the shortest time the timer is armed for, and a step due in less
+        # than half of it is made now rather than that much later
+        self.min_us = 1000000 // max_sps
+        self.early_us = self.min_us // 2
+        self.channels = []
+        self.due = []  # channels that step in the current callback
+        self.callback = self.tick  # bound once
+        self.clock = self.ticks.clock
+        self.diff = self.ticks.diff
+        self.add_us = self.ticks.add
+        self.reset_stats()
+
+    def add(self, pin):
+        channel = Channel(pin)
+        self.channels.append(channel)
+        # preallocated, a callback can step every channel
+        self.due.append(None)
+        return channel
+
+    def start(self, channel, move, followers=(), delay=0):
+        # start a move on a channel, the first step is now, or `delay`
+        # microseconds later
+        # followers: (channel, steps) pairs that step along with this one,
+        # steps no more than the steps of the move
+        channel.steps = 0
+        for follower, steps in followers:
+            follower.steps = 0
+            follower.leader = channel
+            follower.index = 0
+            follower.error = move.steps // 2
+            follower.steps = steps
+        channel.followers = tuple([f for f, _ in followers])
+        channel.interval = move.interval
+        channel.index = 0
+        channel.time = self.add_us(self.clock(), delay)
+        channel.expected = 0
+        channel.leader = None
+        channel.steps = move.steps
+        if move.steps:
+            self.resume()
+
+    def resume(self):
+        # a callback as soon as possible, it arms the timer for the next
+        # step; scheduled, so it does not run along with the timer's
+        try:
+            schedule(self.callback, None)
+        except RuntimeError:
+            # the schedule queue is full, the timer calls back instead
+            self.ticks.start(self.min_us, self.callback)
+
+    def until(self, channel):
+        # microseconds to the next step of a leading channel
+        return self.diff(channel.time, self.clock())
+
+    def cancel(self, channel):
+        # stop the move of a channel, with the move it follows if it is
+        # still following one
+        if channel.leader is not None and channel.index < channel.steps:
+            channel = channel.leader
+        channel.steps = channel.index
+        for follower in channel.followers:
+            follower.steps = follower.index
+            follower.leader = None
+        channel.followers = ()
+
+    def tick(self, _):
+        now = self.clock()
+        due = self.due
+        n = 0
+        for channel in self.channels:
+            if channel.leader is None and channel.index < channel.steps and \
+                    self.diff(channel.time, now) <= self.early_us:
+                channel.set(1)
+                due[n] = channel
+                n += 1
+                for follower in channel.followers:
+                    follower.error += follower.steps
+                    if follower.error >= channel.steps:
+                        follower.error -= channel.steps
+                        follower.set(1)
+                        due[n] = follower
+                        n += 1
+                        follower.index += 1
+                if channel.index:
+                    error = self.diff(now, channel.last) - channel.expected
+                    if error < 0:
+                        error = -error
+                    if error > self.jitter_max:
+                        self.jitter_max = error
+                    self.jitter_total += error
+                    self.measured += 1
+                channel.last = now
+                channel.expected = channel.interval(channel.index)
+                # from the planned time of this step, not from now, so the
+                # latency does not accumulate along the move
+                channel.time = self.add_us(channel.time, channel.expected)
+                channel.index += 1
+                if channel.index == channel.steps:
+                    # the followers made their last step with this one
+                    for follower in channel.followers:
+                        follower.leader = None
+                    channel.followers = ()
+                    channel.ended = channel.done is not None
+        # a4988 requires 1 us
+        for i in range(n):
+            due[i].set(0)
+        # the done callbacks of the moves that ended, and the next step due
+        # on any channel
+        active = False
+        wait = 0
+        for channel in self.channels:
+            if channel.ended:
+                try:
+                    schedule(channel.done, channel)
+                    channel.ended = False
+                except RuntimeError:
+                    # the schedule queue is full, again on the next callback
+                    if not active or self.min_us < wait:
+                        wait = self.min_us
+                    active = True
+            if channel.leader is None and channel.index < channel.steps:
+                until = self.diff(channel.time, now)
+                if not active or until < wait:
+                    wait = until
+                active = True
+        if active:
+            # less the time spent since the callback started
+            wait -= self.diff(self.clock(), now)
+            self.ticks.start(wait if wait > self.min_us else self.min_us,
+                             self.callback)
+        else:
+            self.ticks.stop()
+
+    def reset_stats(self):
+        self.jitter_max = 0
+        self.jitter_total = 0
+        self.measured = 0
+
+    def stats(self):
+        return {
+            'max_sps': self.max_sps,
+            'pulses_measured': self.measured,
+            'jitter_max_us': self.jitter_max,
+            'jitter_mean_us': self.jitter_total / self.measured
+            if self.measured else 0,
+        }
+
+# -----------------------------------------------
+# simulation
+# -----------------------------------------------
+
+if __name__ == '__main__':
+    from motion import Move
+
+    class RecordingPin:
+        # records the clock of each rising edge
+        def __init__(self, clock):
+            self.clock = clock
+            self.state = 0
+            self.edges = []
+
+        def value(self, v=None):
+            if v is None:
+                return self.state
+            if v and not self.state:
+                self.edges.append(self.clock())
+            self.state = v
+
+    def run(ticks):
+        callbacks = 0
+        while ticks.callback:
+            ticks.tick()
+            callbacks += 1
+        return callbacks
+
+    def constant(steps, sps):
+        return Move(steps, (), 0, 1000000 // sps, (), 0)
+
+    # one channel at max_sps and one much slower, started 7 us later
+    ticks = ManualTicks()
+    generator = StepGenerator(ticks, max_sps=20000)
+    fast = generator.add(RecordingPin(ticks.clock))
+    slow = generator.add(RecordingPin(ticks.clock))
+    generator.start(fast, constant(2000, 20000))
+    generator.start(slow, constant(30, 300), delay=7)
+    callbacks = run(ticks)
+    for name, channel in (('fast', fast), ('slow', slow)):
+        edges = channel.pin.edges
+        print('{0}: {1} pulses in {2} us'.format(name, len(edges),
+                                                  edges[-1] - edges[0]))
+    print('{0} callbacks for {1} pulses, timer stopped: {2}, {3}'.format(
+        callbacks, len(fast.pin.edges) + len(slow.pin.edges),
+        ticks.callback is None, generator.stats()))
+
+    # a follower steps on the lead pulses and is released at the end
+    generator.reset_stats()
+    fast.pin.edges, slow.pin.edges = [], []
+    generator.start(fast, constant(100, 1000), [(slow, 37)])
+    run(ticks)
+    print('follower: {0} pulses for 37, all on lead pulses: {1}, '
+          'released: {2}'.format(len(slow.pin.edges),
+                                 set(slow.pin.edges) <= set(fast.pin.edges),
+                                 slow.leader is None))
+
+    # the schedule queue is full when the move ends: done is scheduled on
+    # a later callback, the timer is not left stopped
+    queued = schedule
+    refusals = [3]
+    done = []
+
+    def schedule(function, arg):
+        if function is not generator.callback and refusals[0]:
+            refusals[0] -= 1
+            raise RuntimeError('schedule queue full')
+        queued(function, arg)
+
+    fast.done = done.append
+    generator.start(fast, constant(10, 1000))
+    run(ticks)
+    print('done called {0} time(s) after {1} refusals'.format(
+        len(done), 3 - refusals[0]))
+
+# -----------------------------------------------
+# end
+# -----------------------------------------------
@@ -10,6 +10,58 @@
 
 import time
 from machine import Pin
+from motion import Move
+
+try:
+    from machine import mem32
+except ImportError:
+    mem32 = None
+
+# -----------------------------------------------
+# gpio port writes
+# -----------------------------------------------
+
+# ESP32 output set and clear registers, for pins 0-31 (a 1 bit sets or
+# clears the pin, a 0 bit leaves it as it is)
+GPIO_OUT_W1TS = 0x3FF44008
+GPIO_OUT_W1TC = 0x3FF4400C
+
+
+def port_writes(pins):
+    # True if the pins can be written with one register write: an original
+    # ESP32 (the S2, S3 and C series have other registers) and pins 0-31
+    if mem32 is None:
+        return False
+    try:
+        import os
+        chip = os.uname().machine
+    except (ImportError, AttributeError):
+        return False
+    if 'ESP32' not in chip:
+        return False
+    for variant in ('ESP32S', 'ESP32C', 'ESP32H'):
+        if variant in chip:
+            return False
+    for pin in pins:
+        if not 0 <= pin < 32:
+            return False
+    return True
+
+
+# -----------------------------------------------
+# timing
+# -----------------------------------------------
+
+def wait_until(deadline):
+    # sleep to a ticks_us deadline instead of polling the clock: the whole
+    # milliseconds with sleep_ms, which lets the other threads run, and the
+    # rest with one sleep_us
+    remaining = time.ticks_diff(deadline, time.ticks_us())
+    if remaining >= 1000:
+        time.sleep_ms(remaining // 1000)
+        remaining = time.ticks_diff(deadline, time.ticks_us())
+    if remaining > 0:
+        time.sleep_us(remaining)
 
 
 # -----------------------------------------------
@@ -73,7 +125,8 @@ class HBRIDGE:
                  sleep=False,  # start in sleep mode
                  sps=200,  # steps-per-second
                  smax=10240,  # max step count allowed
-                 smin=-10240  # min step count allowed
+                 smin=-10240,  # min step count allowed
+                 port=None  # one register write per step, None to detect
                  ):
 
         # set mode (delete others)
@@ -126,6 +179,21 @@ class HBRIDGE:
         self.p3 = Pin(a, Pin.OUT, istate[2])
         self.p4 = Pin(b, Pin.OUT, istate[3])
 
+        # port writes, (set mask, clear mask) for each state, in pin order
+        if port is None:
+            port = port_writes((A, B, a, b))
+        self.masks = None
+        if port:
+            self.masks = {}
+            for state in self.mode + (self.xstate,):
+                setm, clearm = 0, 0
+                for pin, value in zip((A, B, a, b), state):
+                    if value:
+                        setm |= 1 << pin
+                    else:
+                        clearm |= 1 << pin
+                self.masks[state] = (setm, clearm)
+
         # step tracking
         self.steps = 0  # current step count
         self.last = time.ticks_us()  # ticks_us of last pset
@@ -145,12 +213,19 @@ class HBRIDGE:
         self.isoff = False
 
     def pset(self, state, waitfor=None):
-        while waitfor and time.ticks_diff(time.ticks_us(), waitfor) < 0:
-            time.sleep_us(10)
-        self.p1.value(state[0])
-        self.p2.value(state[1])
-        self.p3.value(state[2])
-        self.p4.value(state[3])
+        if waitfor:
+            wait_until(waitfor)
+        if self.masks:
+            # clear before set, the coils going off are never on together
+            # with the ones coming on
+            setm, clearm = self.masks[state]
+            mem32[GPIO_OUT_W1TC] = clearm
+            mem32[GPIO_OUT_W1TS] = setm
+        else:
+            self.p1.value(state[0])
+            self.p2.value(state[1])
+            self.p3.value(state[2])
+            self.p4.value(state[3])
         self.last = time.ticks_us()
 
     def step(self, steps, sps=None, sleep=False):
@@ -355,6 +430,28 @@ class HBRIDGE:
             sys.print_exception(e)
 
 
+# -----------------------------------------------
+# h-bridge benchmark
+# -----------------------------------------------
+
+def benchmark(A, a, B, b, steps=2000):
+    # max steps-per-second of each mode, with port and with per-pin writes
+    # (the motor should be disconnected, it cannot follow these speeds)
+    results = {}
+    for port in (True, False):
+        if port and not port_writes((A, B, a, b)):
+            continue
+        for mode in (1, 2, 3):
+            motor = HBRIDGE(A, a, B, b, mode=mode, port=port,
+                            smax=steps, smin=-steps)
+            start = time.ticks_us()
+            motor.step(steps, sps=1000000)
+            elapsed = time.ticks_diff(time.ticks_us(), start)
+            motor.sleep()
+            results['mode{0} {1}'.format(mode, 'port' if port else 'pins')] = \
+                int(steps * 1000000 / max(1, elapsed))
+    return results
+
 # -----------------------------------------------
 # a4899 stepper driver class
 # -----------------------------------------------
@@ -374,7 +471,9 @@ class A4899(HBRIDGE):
                  sleep=False,  # start in sleep mode
                  sps=200,  # steps-per-second
                  smax=0,  # max step count allowed
-                 smin=0  # min step count allowed
+                 smin=0,  # min step count allowed
+                 profile=None,  # motion.Profile, None for constant speed
+                 generator=None  # stepgen.StepGenerator, None to busy-wait
                  ):
 
         # no modes (set by dip switch)
@@ -410,6 +509,10 @@ class A4899(HBRIDGE):
         self.smin = smin
         self.stop = False  # stop flag
         self.running = False  # running flag
+        self.profile = profile  # acceleration profile
+        self.generator = generator  # timer step generation
+        if generator:
+            self.channel = generator.add(self.ps)
 
     def sleep(self):
         self.pe.value(self.sleepis)
@@ -434,6 +537,10 @@ class A4899(HBRIDGE):
         # local tracking
         sc = 0  # step count
 
+        # no faster than the generator can step
+        if self.generator:
+            sps = min(sps or self.sps, self.generator.max_sps)
+
         # accurate timing
         stime = int(round(1000000 / max(1, (sps or self.sps)), 0))
         #                 (   timenow -                  (lastpset + stime)) >= 0:
@@ -442,6 +549,13 @@ class A4899(HBRIDGE):
         else:
             waitfor = time.ticks_add(self.last, stime)
 
+        # acceleration profile, intervals planned before the first step
+        if self.profile:
+            move = self.profile.plan(steps, sps or self.sps)
+            interval = move.interval
+        else:
+            move = None
+
         # wake
         if self.isoff:
             self.wake()
@@ -454,14 +568,22 @@ class A4899(HBRIDGE):
             self.pd.value(self.forward)
             sv = 1
 
+        # step from the timer, this thread only waits
+        if self.generator:
+            return self._generate(move or Move(abs(steps), (), 0, stime,
+                                               (), 0), sv, sleep)
+
         # step
         for s in range(abs(steps)):
             if self.stop:
                 break
-            while waitfor and time.ticks_diff(time.ticks_us(), waitfor) < 0:
-                time.sleep_us(10)
+            if waitfor:
+                wait_until(waitfor)
             self.last = time.ticks_us()
-            waitfor = time.ticks_add(waitfor, stime)
+            if move:
+                waitfor = time.ticks_add(waitfor, interval(s))
+            else:
+                waitfor = time.ticks_add(waitfor, stime)
             self.ps.value(1)
             time.sleep_us(10)  # a4988 requires 1 us
             self.ps.value(0)
@@ -477,6 +599,27 @@ class A4899(HBRIDGE):
         self.running = False
         return self.steps
 
+    def _generate(self, move, sv, sleep):
+        generator = self.generator
+        channel = self.channel
+        generator.start(channel, move)
+        while channel.running:
+            if self.stop:
+                generator.cancel(channel)
+                break
+            time.sleep_ms(1)
+
+        # sleep
+        if sleep:
+            self.sleep()
+
+        # done
+        self.last = time.ticks_us()
+        self.steps += channel.index * sv
+        self.stop = False
+        self.running = False
+        return self.steps
+
     def beep(self, freq=440, time_ms=250, pause=0, sleep=False):
 
         # determine steps based on freq and period
@@ -498,8 +641,8 @@ class A4899(HBRIDGE):
 
             # forward
             self.pd.value(self.forward)
-            while waitfor and time.ticks_diff(time.ticks_us(), waitfor) < 0:
-                time.sleep_us(10)
+            if waitfor:
+                wait_until(waitfor)
             self.last = time.ticks_us()
             waitfor = time.ticks_add(waitfor, stime)
             self.ps.value(1)
@@ -508,8 +651,8 @@ class A4899(HBRIDGE):
 
             # back
             self.pd.value(self.reverse)
-            while waitfor and time.ticks_diff(time.ticks_us(), waitfor) < 0:
-                time.sleep_us(10)
+            if waitfor:
+                wait_until(waitfor)
             self.last = time.ticks_us()
             waitfor = time.ticks_add(waitfor, stime)
             self.ps.value(1)
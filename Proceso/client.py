@@ -0,0 +1,236 @@
+import asyncio
+import json as jsonlib
+import socket
+from time import monotonic
+from urllib.parse import urlsplit
+
+
+class HTTPError(Exception):
+    pass
+
+
+class Response:
+    def __init__(self, status_code, reason, headers, content):
+        self.status_code = status_code
+        self.reason = reason
+        self.headers = headers
+        self.content = content
+
+    @property
+    def text(self):
+        return self.content.decode()
+
+    def json(self):
+        return jsonlib.loads(self.content)
+
+
+class Resolver:
+    """Cache of the addresses of the nodes, shared by their clients.
+
+    An address is kept for `ttl` seconds, the TTL the DNS server of the
+    Server node gives its answers, so a node is not looked up again for
+    every new connection. `overrides` maps names to fixed addresses that are
+    never looked up. An address is dropped when a connection to it fails,
+    so a node that moved is looked up again.
+    """
+
+    def __init__(self, ttl=30, overrides=None):
+        self.ttl = ttl
+        self.overrides = dict(overrides or {})
+        self.cache = {}  # name -> (address, expiry)
+        self.lookups = 0
+        self.saved = 0
+
+    async def resolve(self, host, port):
+        address = self.overrides.get(host)
+        if address is None:
+            address, expiry = self.cache.get(host, (None, 0))
+            if expiry <= monotonic():
+                self.lookups += 1
+                infos = await asyncio.get_running_loop().getaddrinfo(
+                    host, port, family=socket.AF_INET, type=socket.SOCK_STREAM)
+                address = infos[0][4][0]
+                self.cache[host] = (address, monotonic() + self.ttl)
+                return address
+        self.saved += 1
+        return address
+
+    def forget(self, host):
+        self.cache.pop(host, None)
+
+    def stats(self, reset=False):
+        stats = {'lookups': self.lookups, 'saved': self.saved}
+        if reset:
+            self.lookups = 0
+            self.saved = 0
+        return stats
+
+
+class Client:
+    """HTTP/1.1 client for one node, with a pool of keep-alive connections.
+
+    Up to `connections` requests run at the same time, each on its own
+    connection; the connections are kept open and reused by the next
+    requests; one idle for more than `keep_alive` seconds is closed instead,
+    before the node closes it (Microdot does after 5 seconds). A request that
+    fails is tried again `retries` more times when that is safe: always if it
+    was not sent, because the connection could not be opened or was found
+    closed by the node, and only for GET requests if it failed after being
+    sent, so a command is never run twice. The name of the node is resolved
+    through `resolver`, a Resolver.
+    """
+
+    def __init__(self, base_url, connections=4, timeout=10, retries=2,
+                 backoff=0.2, resolver=None, keep_alive=4):
+        parts = urlsplit(base_url)
+        self.host = parts.hostname
+        self.port = parts.port or 80
+        self.resolver = resolver or Resolver()
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.keep_alive = keep_alive
+        self.connections = connections
+        self.idle = []  # open connections, (reader, writer, idle since)
+        self.semaphore = None
+        self.requests = 0
+        self.connects = 0
+
+    async def get(self, path, **kwargs):
+        return await self.request('GET', path, **kwargs)
+
+    async def post(self, path, json=None, **kwargs):
+        return await self.request('POST', path, json=json, **kwargs)
+
+    async def request(self, method, path, json=None, timeout=None,
+                      retries=None):
+        if self.semaphore is None:
+            # created here, inside the running event loop
+            self.semaphore = asyncio.Semaphore(self.connections)
+        timeout = self.timeout if timeout is None else timeout
+        retries = self.retries if retries is None else retries
+        head, body = self._serialize(method, path, json)
+        attempt = 0
+        while True:
+            async with self.semaphore:
+                try:
+                    return await self._send(head, body, timeout)
+                except _Stale:
+                    # the node closed an idle connection, nothing was sent
+                    continue
+                except _ConnectError as exc:
+                    error = exc.__cause__
+                except (OSError, asyncio.TimeoutError, HTTPError,
+                        asyncio.IncompleteReadError) as exc:
+                    if method != 'GET':
+                        raise
+                    error = exc
+            if attempt >= retries:
+                raise error
+            await asyncio.sleep(self.backoff * 2 ** attempt)
+            attempt += 1
+
+    def _serialize(self, method, path, json):
+        headers = ['{0} {1} HTTP/1.1'.format(method, path),
+                   'Host: {0}'.format(self.host)]
+        body = b''
+        if json is not None:
+            body = jsonlib.dumps(json).encode()
+            headers.append('Content-Type: application/json')
+        if body or method != 'GET':
+            headers.append('Content-Length: {0}'.format(len(body)))
+        return ('\r\n'.join(headers) + '\r\n\r\n').encode(), body
+
+    async def _send(self, head, body, timeout):
+        reused = False
+        while self.idle:
+            reader, writer, since = self.idle.pop()
+            if reader.at_eof() or monotonic() - since > self.keep_alive:
+                writer.close()
+            else:
+                reused = True
+                break
+        if not reused:
+            try:
+                address = await self.resolver.resolve(self.host, self.port)
+                reader, writer = await asyncio.wait_for(
+                    asyncio.open_connection(address, self.port), timeout)
+            except (OSError, asyncio.TimeoutError) as exc:
+                self.resolver.forget(self.host)
+                raise _ConnectError() from exc
+            self.connects += 1
+        try:
+            writer.write(head + body)
+            await writer.drain()
+        except OSError as exc:
+            # the node closed the connection before the request reached it
+            writer.close()
+            if reused:
+                raise _Stale() from exc
+            raise
+        except BaseException:
+            writer.close()
+            raise
+        # from here the node may have run the request
+        try:
+            line = await asyncio.wait_for(reader.readline(), timeout)
+            if not line:
+                raise asyncio.IncompleteReadError(b'', None)
+            response, keep_alive = await asyncio.wait_for(
+                self._read_response(line, reader), timeout)
+        except BaseException:
+            writer.close()
+            raise
+        self.requests += 1
+        if keep_alive:
+            self.idle.append((reader, writer, monotonic()))
+        else:
+            writer.close()
+        return response
+
+    async def _read_response(self, line, reader):
+        try:
+            version, status, *reason = line.decode().rstrip('\r\n').split(
+                ' ', 2)
+            status = int(status)
+        except ValueError:
+            raise HTTPError('Invalid status line: {0!r}'.format(line))
+        headers = {}
+        while True:
+            line = await reader.readline()
+            if line in (b'\r\n', b'\n', b''):
+                break
+            name, _, value = line.decode().partition(':')
+            headers[name.strip().lower()] = value.strip()
+        connection = headers.get('connection', '').lower()
+        keep_alive = connection == 'keep-alive' or (
+            version == 'HTTP/1.1' and connection != 'close')
+        if headers.get('transfer-encoding', '').lower() == 'chunked':
+            chunks = []
+            while True:
+                size = int((await reader.readline()).split(b';')[0], 16)
+                if size == 0:
+                    await reader.readline()
+                    break
+                chunks.append(await reader.readexactly(size))
+                await reader.readline()
+            content = b''.join(chunks)
+        elif 'content-length' in headers:
+            content = await reader.readexactly(int(headers['content-length']))
+        else:
+            content = await reader.read()
+            keep_alive = False
+        return Response(status, reason[0] if reason else '', headers,
+                        content), keep_alive
+
+    def close(self):
+        while self.idle:
+            self.idle.pop()[1].close()
+
+
+class _Stale(Exception):
+    pass
+
+
+class _ConnectError(Exception):
+    pass
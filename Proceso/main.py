@@ -1,7 +1,24 @@
-import requests
-from time import sleep
+import asyncio
+from time import perf_counter
+from client import Client, Resolver
 
 hosts = ('http://sensors.ita', 'http://motors.ita')
+# fixed addresses of the nodes, looked up in the DNS of the Server node when
+# not here, e.g. {'sensors.ita': '192.168.4.3', 'motors.ita': '192.168.4.4'}
+addresses = {}
+# the addresses looked up are kept for the 30 seconds TTL of its answers
+resolver = Resolver(ttl=30, overrides=addresses)
+# a pool of keep-alive connections per node, created in main()
+sensors = None
+motors = None
+# the cube is in front of the sensors when it is closer than this
+CUBE_DISTANCE_CM = 10
+# a cube hit the piezo of its bin when the mean of this many samples (5 ms
+# apart) of the piezo is above PIEZO_LEVEL
+PIEZO_SAMPLES = 50
+PIEZO_LEVEL = 0.8
+# the lights are on for this long before each cube
+ALERT_SECONDS = 3
 current_position = 0  # 0 for plastic, 1 for wood and 2 for metal
 start = False
 stop = False
@@ -34,135 +51,278 @@ def position(pos: int) -> int:
     return steps
 
 
-def status():
+async def batch(*commands):
+    # schedule several motor commands with a single round trip, each command
+    # can have a 'delay' in seconds relative to this request
+    return await motors.post('/batch', json=list(commands))
+
+
+async def queue(stepper, steps, speed, pause=0):
+    # queue a stepper move after the ones already sent, starting `pause`
+    # seconds after the previous one ends
+    return await motors.post(f'/stepper/{stepper}/append?steps={steps}&speed={speed}'
+                             f'&pause={int(pause * 1000)}')
+
+
+async def wait_stepper(stepper):
+    # wait until the queued moves of a stepper end, the node answers when
+    # they do (or after 60 seconds, then ask again)
+    while not (await motors.get(f'/stepper/{stepper}/wait?timeout=60',
+                                timeout=70)).json()['done']:
+        pass
+
+
+async def wait_sample(name, timeout, **condition):
+    # wait until a sensor reading meets a condition (above=x or below=x, and
+    # n=samples), at most `timeout` seconds; True if it did
+    args = '&'.join(f'{key}={value}' for key, value in condition.items())
+    return (await sensors.get(f'/samples/{name}/wait?timeout={timeout}&{args}',
+                              timeout=timeout + 10)).json()['done']
+
+
+async def status():
     result = True
-    for host in hosts:
-        try:
-            r = requests.get(f'{host}/')
-            result = result and r.status_code == 200
-            if r.status_code == 200:
-                print(f'{host} = Working')
-            else:
-                print(f'{host} = Failing')
-            print(r.text)
-        except Exception as e:
-            print(e)
+    responses = await asyncio.gather(sensors.get('/'), motors.get('/'),
+                                     return_exceptions=True)
+    for host, r in zip(hosts, responses):
+        if isinstance(r, Exception):
+            print(r)
+            continue
+        result = result and r.status_code == 200
+        if r.status_code == 200:
+            print(f'{host} = Working')
+        else:
+            print(f'{host} = Failing')
+        print(r.text)
 
     return result
 
 
-def process():
-    # Start the process
-    # Enable the lights with a post to the sensors.ita
-    print('Starting process')
+async def classify():
+    # Wait for the next cube in front of the sensors and tell what it is,
+    # 0 for plastic, 1 for wood and 2 for metal, None if stopped
     print('Alert')
-    requests.post(f'{hosts[0]}/relay/0?enable=1')
-    requests.post(f'{hosts[0]}/relay/4?enable=1')
+    await asyncio.gather(sensors.post('/relay/0?enable=1'),
+                         sensors.post('/relay/4?enable=1'))
     if stop:
-        return
-    sleep(3)
+        return None
+    await asyncio.sleep(ALERT_SECONDS)
     print('Disable alert')
-    requests.post(f'{hosts[0]}/relay/0?enable=0')
-    requests.post(f'{hosts[0]}/relay/4?enable=0')
+    await asyncio.gather(sensors.post('/relay/0?enable=0'),
+                         sensors.post('/relay/4?enable=0'))
     if stop:
-        return
-    sleep(5)
-    print('Know if is metal')
-    is_metal = int(requests.get(f'{hosts[0]}/metal').json()['is_metal'])
-    is_wood = False
-    is_plastic = False
-    if not is_metal:
-        print('Get colors')
-        colours = requests.get(f'{hosts[0]}/colour').json()
-        red = colours['red']
-        green = colours['green']
-        blue = colours['blue']
-        # Wood -> Green > 20, Red < 20, Blue < 20
-        is_wood = green > 20 > blue and red < 20
-        is_plastic = not is_wood
+        return None
+    # the cube reaches the sensors in up to 5 seconds
+    await wait_sample('distance', 5, below=CUBE_DISTANCE_CM)
+    print('Know if is metal and get colors')
+    metal, colours = await asyncio.gather(sensors.get('/metal'),
+                                          sensors.get('/colour'))
+    if int(metal.json()['is_metal']):
+        return 2
+    colours = colours.json()
+    red = colours['red']
+    green = colours['green']
+    blue = colours['blue']
+    # Wood -> Green > 20, Red < 20, Blue < 20
+    is_wood = green > 20 > blue and red < 20
+    return 1 if is_wood else 0
 
-    if stop:
-        return
+
+async def convey(kind):
+    # Take the cube from the sensors to its bin
     print('Choose the path of the cube')
-    requests.post(f'{hosts[0]}/relay/{3 if is_metal else 2 if is_plastic else 1}?enable=1')
-    # enable the servomotor giving an angle
-    requests.post(f'{hosts[1]}/servo/{2 if is_metal else 1 if is_plastic else 0}?angle=90')
-    # enable the motor for 5 seconds
-    requests.post(f'{hosts[1]}/motors/0?time=15&direction=1')
-    # enable the stepper motor for 5 seconds
-    requests.post(f'{hosts[1]}/stepper/0?steps=700000&speed=5000')
-    # read the piezo sensor and give a time out of 15 seconds
-    if stop:
-        return
-    sleep(20)
+    # light the path, and at the same time enable the servomotor giving an
+    # angle, the motor for 15 seconds and the stepper motor
+    await asyncio.gather(
+        sensors.post(f'/relay/{(2, 1, 3)[kind]}?enable=1'),
+        batch({'type': 'servo', 'id': (1, 0, 2)[kind], 'angle': 90},
+              {'type': 'motor', 'id': 0, 'time': 15, 'direction': 1},
+              {'type': 'stepper', 'id': 0, 'steps': 700_000, 'speed': 5000}))
+
+
+async def arrive(kind):
+    # read the piezo sensor of the bin and give a time out of 20 seconds
+    await wait_sample(f'piezo{(1, 0, 2)[kind]}', 20,
+                      above=PIEZO_LEVEL, n=PIEZO_SAMPLES)
     print('Stop the stepper motor')
     # enable the motor for 5 seconds in reverse
-    requests.post(f'{hosts[1]}/motors/0?time=15&direction=-1')
-    requests.post(f'{hosts[1]}/stop')
-    if stop:
-        return
+    await asyncio.gather(motors.post('/motors/0?time=15&direction=-1'),
+                         motors.post('/stop'))
 
-    result = False
-    steps = 0
 
-    if is_metal:
+async def sort(kind):
+    # Push the cube out of the path and move the segment
+    if kind == 2:
         print('Is metal')
-        requests.post(f'{hosts[1]}/stepper/3?steps=18000&speed=20000')
+        await queue(3, 18_000, 20000)
+        await queue(3, -18_000, 20000, pause=1)
+        await wait_stepper(3)
         if stop:
-            return
-        sleep(1)
-        requests.post(f'{hosts[1]}/stepper/3?steps=-18000&speed=20000')
-        sleep(1)
-        requests.post(f'{hosts[0]}/relay/3?enable=0')
-        result = True
+            return False
+        await sensors.post('/relay/3?enable=0')
         steps = position(2)
-    elif is_wood:
+    elif kind == 1:
         print('Is wood')
-        requests.post(f'{hosts[1]}/stepper/1?steps=15000&speed=1000')
-        if stop:
-            return
-        sleep(16)
-        requests.post(f'{hosts[1]}/stepper/1?steps=-15000&speed=1000')
+        await queue(1, 15_000, 1000)
+        await queue(1, -15_000, 1000, pause=1)
+        await wait_stepper(1)
         if stop:
-            return
-        sleep(16)
-        requests.post(f'{hosts[0]}/relay/1?enable=0')
-        result = True
+            return False
+        await sensors.post('/relay/1?enable=0')
         steps = position(1)
-    elif is_plastic:
+    else:
         print('Is plastic')
-        requests.post(f'{hosts[1]}/stepper/2?steps=-20000&speed=4000')
+        await queue(2, -20_000, 4000)
+        await wait_stepper(2)
         if stop:
-            return
-        sleep(6)
-        requests.post(f'{hosts[1]}/motors/1?time=0.1&direction=1')
-        sleep(1)
-        requests.post(f'{hosts[1]}/stepper/2?steps=20000&speed=4000')
+            return False
+        await motors.post('/motors/1?time=0.1&direction=1')
+        await queue(2, 20_000, 4000, pause=1)
+        await wait_stepper(2)
         if stop:
-            return
-        sleep(6)
-        requests.post(f'{hosts[0]}/relay/2?enable=0')
-        result = True
+            return False
+        await sensors.post('/relay/2?enable=0')
         steps = position(0)
 
     if stop:
-        return
+        return False
     print('Choose the segment')
-    requests.post(f'{hosts[1]}/stepper/4?steps={steps}&speed=2000')
-    requests.post(f'{hosts[0]}/release')
+    await asyncio.gather(queue(4, steps, 2000), sensors.post('/release'))
+    return True
+
+
+class Timings:
+    # duration of each stage of every item, and the items per minute
 
+    def __init__(self):
+        self.stages = {}  # name -> list of seconds
+        self.started = None
+        self.finished = None
+        self.items = 0
+
+    def add(self, stage, seconds):
+        self.stages.setdefault(stage, []).append(seconds)
+
+    async def time(self, stage, awaitable):
+        t = perf_counter()
+        if self.started is None:
+            self.started = t
+        try:
+            return await awaitable
+        finally:
+            self.add(stage, perf_counter() - t)
+
+    def done(self):
+        self.items += 1
+        self.finished = perf_counter()
+
+    def items_per_minute(self):
+        if not self.items:
+            return 0
+        return self.items * 60 / (self.finished - self.started)
+
+    def report(self):
+        for stage, seconds in self.stages.items():
+            print(f'{stage}: mean {sum(seconds) / len(seconds):.2f} s, '
+                  f'max {max(seconds):.2f} s, {len(seconds)} items')
+        print(f'{self.items} items, {self.items_per_minute():.2f} items/minute')
+
+
+def report(timings):
+    # after each cube: the timings, and the lookups of the node addresses
+    # since the last cube
+    timings.report()
+    stats = resolver.stats(reset=True)
+    print(f"DNS lookups: {stats['lookups']}, saved: {stats['saved']}")
+
+
+async def process(timings=None):
+    # One cube from the sensors to its bin, then the next one
+    timings = timings or Timings()
+    print('Starting process')
+    kind = await timings.time('classify', classify())
+    if kind is None or stop:
+        return
+    await timings.time('convey', convey(kind))
+    if stop:
+        return
+    await timings.time('arrive', arrive(kind))
+    if stop:
+        return
+    result = await timings.time('sort', sort(kind))
+    if result:
+        timings.done()
+        report(timings)
     return 'OK' if result else 'FAIL'
 
 
-def send_stop():
+async def pipeline(timings=None, items=None):
+    # The sensors classify the next cube while the current one is carried
+    # and sorted: the classified cube waits in front of the sensors until the
+    # conveyor is free, and the sensors look for the next one as soon as it
+    # has been taken. The actuators handle one cube at a time, in order.
+    # items: stop after this many cubes, None to run forever
+    timings = timings or Timings()
+    classified = asyncio.Queue(maxsize=1)
+
+    async def sensing():
+        count = 0
+        while items is None or count < items:
+            kind = await timings.time('classify', classify())
+            if kind is None or stop:
+                break
+            t = perf_counter()
+            await classified.put(kind)
+            # until the conveyor has taken the cube, it is in front of the
+            # sensors
+            await classified.join()
+            timings.add('waiting', perf_counter() - t)
+            count += 1
+        await classified.put(None)
+
+    async def actuating():
+        while True:
+            kind = await classified.get()
+            if kind is None:
+                break
+            try:
+                # when stopped, take the cubes until the sensors stop too
+                if stop:
+                    continue
+                await timings.time('convey', convey(kind))
+            finally:
+                classified.task_done()
+            if stop:
+                continue
+            await timings.time('arrive', arrive(kind))
+            if stop:
+                continue
+            if await timings.time('sort', sort(kind)):
+                timings.done()
+                report(timings)
+
+    await asyncio.gather(sensing(), actuating())
+    return timings
+
+
+async def send_stop():
     global stop
 
-    requests.post(f'{hosts[1]}/stop')
-    requests.post(f'{hosts[0]}/stop')
+    await asyncio.gather(motors.post('/stop'), sensors.post('/stop'))
     stop = False
 
 
-process()
+def connect(sensors_url=hosts[0], motors_url=hosts[1]):
+    global sensors, motors
+
+    sensors = Client(sensors_url, resolver=resolver)
+    motors = Client(motors_url, resolver=resolver)
+
+
+async def main():
+    connect()
+    await pipeline()
+
 
-while True:
-    process()
+if __name__ == '__main__':
+    asyncio.run(main())
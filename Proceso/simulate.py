@@ -0,0 +1,189 @@
+import asyncio
+import json
+import sys
+from time import perf_counter
+from urllib.parse import urlsplit, parse_qsl
+
+import main
+
+# Stand-in Sensors and Motors nodes on localhost, to run the process without
+# the machine and compare one cube at a time with the pipeline:
+#   python3 simulate.py [items] [speedup]
+# The nodes answer the endpoints the process uses, with the plant times
+# below divided by the speedup; the timings are reported in plant seconds.
+
+SENSORS_PORT = 18081
+MOTORS_PORT = 18082
+ARRIVAL_SECONDS = 2  # from the conveyor taking a cube to the next one in place
+TRAVEL_SECONDS = 8  # from the conveyor start to the bin
+KEEP_ALIVE_SECONDS = 5  # Microdot.keep_alive_timeout
+KINDS = (0, 2, 1, 0, 2, 0, 1, 2)  # plastic, metal, wood... in turn
+speedup = 20
+
+
+def plant_time():
+    return perf_counter() * speedup
+
+
+async def sleep(seconds):
+    await asyncio.sleep(seconds / speedup)
+
+
+class Plant:
+    # the cubes, the sensors station, the bins and the stepper queues
+
+    def __init__(self, items):
+        self.kinds = [KINDS[i % len(KINDS)] for i in range(items)]
+        self.next = 0
+        self.station = None  # kind of the cube in front of the sensors
+        self.changed = asyncio.Condition()
+        self.landed = [0, 0, 0]  # cubes in each bin, by piezo
+        self.steppers = {}  # id -> plant time its queue ends
+
+    async def notify(self):
+        async with self.changed:
+            self.changed.notify_all()
+
+    async def wait_for(self, predicate, timeout):
+        async with self.changed:
+            try:
+                await asyncio.wait_for(self.changed.wait_for(predicate),
+                                       timeout / speedup)
+                return True
+            except asyncio.TimeoutError:
+                return False
+
+    async def feed(self):
+        await sleep(ARRIVAL_SECONDS)
+        if self.next < len(self.kinds):
+            self.station = self.kinds[self.next]
+            self.next += 1
+            await self.notify()
+
+    async def carry(self):
+        kind = self.station
+        self.station = None
+        asyncio.ensure_future(self.feed())
+        await sleep(TRAVEL_SECONDS)
+        self.landed[(1, 0, 2)[kind]] += 1
+        await self.notify()
+
+    def append(self, stepper, steps, speed, pause):
+        start = max(plant_time(), self.steppers.get(stepper, 0))
+        self.steppers[stepper] = start + pause + abs(steps) / speed
+
+    async def sensors(self, method, path, args, body):
+        if path.startswith('/samples/') and path.endswith('/wait'):
+            name = path.split('/')[2]
+            timeout = float(args.get('timeout', 30))
+            if name == 'distance':
+                done = await self.wait_for(lambda: self.station is not None,
+                                           timeout)
+                return {'done': done, 'value': 5 if done else 100}
+            bin = int(name[len('piezo'):])
+            landed = self.landed[bin]
+            done = await self.wait_for(lambda: self.landed[bin] > landed,
+                                       timeout)
+            return {'done': done, 'value': 1 if done else 0}
+        if path == '/metal':
+            return {'is_metal': self.station == 2}
+        if path == '/colour':
+            if self.station == 1:
+                return {'red': 10, 'green': 40, 'blue': 10}
+            return {'red': 60, 'green': 60, 'blue': 60}
+        return 'OK'
+
+    async def motors(self, method, path, args, body):
+        if path == '/batch':
+            for command in body:
+                if command['type'] == 'stepper' and command['id'] == 0:
+                    asyncio.ensure_future(self.carry())
+            return 'OK'
+        if path == '/stop':
+            self.steppers.clear()
+            return 'OK'
+        parts = path.split('/')
+        if parts[1] == 'stepper' and parts[3] == 'append':
+            self.append(int(parts[2]), int(args['steps']),
+                        int(args['speed']), int(args.get('pause', 0)) / 1000)
+        elif parts[1] == 'stepper' and parts[3] == 'wait':
+            left = self.steppers.get(int(parts[2]), 0) - plant_time()
+            await sleep(max(0, min(left, float(args.get('timeout', 30)))))
+            return {'done': plant_time() >= self.steppers.get(int(parts[2]), 0)}
+        return 'OK'
+
+
+def serve(handler):
+    async def connection(reader, writer):
+        while True:
+            # the nodes close a connection idle for 5 seconds
+            try:
+                line = await asyncio.wait_for(reader.readline(),
+                                              KEEP_ALIVE_SECONDS / speedup)
+            except asyncio.TimeoutError:
+                break
+            if not line:
+                break
+            method, target, _ = line.decode().split(' ', 2)
+            length = 0
+            while True:
+                header = await reader.readline()
+                if header in (b'\r\n', b''):
+                    break
+                name, _, value = header.decode().partition(':')
+                if name.lower() == 'content-length':
+                    length = int(value)
+            body = json.loads(await reader.readexactly(length)) \
+                if length else None
+            url = urlsplit(target)
+            result = await handler(method, url.path, dict(parse_qsl(url.query)),
+                                   body)
+            content = (json.dumps(result) if isinstance(result, dict)
+                       else result).encode()
+            writer.write(b'HTTP/1.1 200 OK\r\nContent-Length: %d\r\n\r\n'
+                         % len(content) + content)
+            await writer.drain()
+        writer.close()
+    return connection
+
+
+async def run(items, pipelined):
+    plant = Plant(items)
+    sensors = await asyncio.start_server(serve(plant.sensors), '127.0.0.1',
+                                         SENSORS_PORT)
+    motors = await asyncio.start_server(serve(plant.motors), '127.0.0.1',
+                                        MOTORS_PORT)
+    main.connect('http://localhost:{0}'.format(SENSORS_PORT),
+                 'http://localhost:{0}'.format(MOTORS_PORT))
+    main.ALERT_SECONDS = 3 / speedup
+    main.perf_counter = plant_time
+    main.current_position = 0
+    asyncio.ensure_future(plant.feed())
+    timings = main.Timings()
+    if pipelined:
+        await main.pipeline(timings, items)
+    else:
+        for _ in range(items):
+            await main.process(timings)
+    main.sensors.close()
+    main.motors.close()
+    # let the nodes see the connections closed
+    await asyncio.sleep(0.1)
+    for server in (sensors, motors):
+        server.close()
+        await server.wait_closed()
+    return timings
+
+
+if __name__ == '__main__':
+    items = int(sys.argv[1]) if len(sys.argv) > 1 else 8
+    if len(sys.argv) > 2:
+        speedup = float(sys.argv[2])
+    results = []
+    for pipelined in (False, True):
+        print('pipeline' if pipelined else 'one cube at a time')
+        results.append(asyncio.run(run(items, pipelined)))
+    print()
+    for name, timings in zip(('one cube at a time', 'pipeline'), results):
+        print(name)
+        timings.report()
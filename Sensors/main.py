@@ -1,7 +1,8 @@
-from microdot import Microdot
+from microdot import Microdot, Response
 from hcsr04 import HCSR04
 from tcs34725 import TCS34725
 from piezo import Piezo
+from sampler import Sampler
 from machine import Pin
 import network
 import _thread
@@ -41,43 +42,166 @@ for pin in relay_pins:
 
 stop = False
 
+# Sample the sensors in the background, requests are served from the buffers;
+# the colour and distance readings block for tens of milliseconds, the metal
+# sensor and the piezos are read in a second thread to keep their periods
+SAMPLE_PERIODS_MS = {'colour': 100, 'distance': 100, 'metal': 20, 'piezo': 5}
+
+sampler = Sampler()
+sampler.add('colour', lambda: tcs.rgb, SAMPLE_PERIODS_MS['colour'], width=3,
+            typecode='H')
+sampler.add('distance', distance_sensor.distance_cm,
+            SAMPLE_PERIODS_MS['distance'])
+sampler.add('metal', metal_sensor.value, SAMPLE_PERIODS_MS['metal'],
+            typecode='b', thread=1)
+for i, piezo_e in enumerate(piezos):
+    sampler.add('piezo{0}'.format(i), piezo_e.touch_begins,
+                SAMPLE_PERIODS_MS['piezo'], size=256, typecode='b', thread=1)
+sampler.start()
+
 # Create web app
 
 app = Microdot()
 
 
-@app.route("/")
-def index():
+@app.route("/", cache=True)
+def index(request):
     return "Hello World!"
 
 
+def latest_colour():
+    sample = sampler.buffer('colour').latest()
+    if sample is None:
+        red, green, blue = tcs.rgb
+    else:
+        red, green, blue = sample[1]
+    return {'red': red, 'green': green, 'blue': blue}
+
+
+def latest_distance():
+    sample = sampler.buffer('distance').latest()
+    return {'distance': sample[1] if sample else None}
+
+
 @app.get("/colour")
 def color(request):
-    red, green, blue = tcs.rgb
-    return {'red': red, 'green': green, 'blue': blue}
+    return latest_colour()
+
+
+def sensor_stream(request, read):
+    # one reading every `interval` seconds, `count` readings at most, so the
+    # dashboard reconnects instead of holding the server indefinitely
+    interval = float(request.args.get('interval', 0.5))
+    count = int(request.args.get('count', 120))
+
+    def events():
+        for _ in range(count):
+            yield read()
+            time.sleep(interval)
+
+    return Response.event_stream(events(), retry=int(interval * 1000))
+
+
+@app.get("/colour/stream")
+def colour_stream(request):
+    return sensor_stream(request, latest_colour)
+
+
+@app.get("/distance/stream")
+def distance_stream(request):
+    return sensor_stream(request, latest_distance)
+
+
+@app.get("/distance")
+def distance(request):
+    return latest_distance()
 
 
 @app.get("/metal")
 def is_metal(request):
-    metal = metal_sensor.value()
+    sample = sampler.buffer('metal').latest()
+    metal = sample[1] if sample else metal_sensor.value()
     return {'is_metal': metal}
 
 
+@app.get("/samples")
+def samples_stats(request):
+    return sampler.stats()
+
+
+@app.get("/samples/<name>")
+def samples_window(request, name):
+    # the last `n` samples, oldest first, as [age_ms, value] pairs
+    if name not in sampler.channels:
+        return 'Unknown sensor', 404
+    n = int(request.args.get('n', 16))
+    return {'samples': sampler.buffer(name).window(n)}
+
+
+@app.get("/samples/<name>/aggregate")
+def samples_aggregate(request, name):
+    if name not in sampler.channels:
+        return 'Unknown sensor', 404
+    n = int(request.args.get('n', 16))
+    return sampler.buffer(name).aggregate(n)
+
+
+@app.get("/samples/<name>/wait")
+def samples_wait(request, name):
+    # long poll until the mean of the next `n` samples is above or below a
+    # value: ?above=x or ?below=x, &n=1, &timeout=s
+    if name not in sampler.channels:
+        return 'Unknown sensor', 404
+    buffer = sampler.buffer(name)
+    if buffer.width != 1:
+        return 'FAIL'
+    n = int(request.args.get('n', 1))
+    above = request.args.get('above')
+    below = request.args.get('below')
+    deadline = time.ticks_add(time.ticks_ms(),
+                              int(float(request.args.get('timeout', 30)) * 1000))
+    start = buffer.count
+    mean = None
+    while time.ticks_diff(deadline, time.ticks_ms()) > 0:
+        if buffer.count - start >= n:
+            mean = buffer.aggregate(n)['mean']
+            if (above is not None and mean > float(above)) or \
+                    (below is not None and mean < float(below)):
+                return {'done': True, 'value': mean}
+        time.sleep_ms(10)
+    return {'done': False, 'value': mean}
+
+
+@app.post("/samples/<name>/period")
+def samples_period(request, name):
+    if name not in sampler.channels:
+        return 'Unknown sensor', 404
+    sampler.set_period(name, int(request.args['ms']))
+    return 'OK'
+
+
 @app.get("/piezo/<int:identifier>")
-def is_metal(request, identifier):
-    piezo = piezos[identifier]
-    # piezo.calibrate()
-    t = time.time()
+def piezo_hit(request, identifier):
+    # long poll until more than `hits` samples of the piezo are positive,
+    # counted from the sampler buffer: ?hits=150, &timeout=s
+    if identifier >= len(piezos):
+        return 'FAIL'
+    buffer = sampler.buffer('piezo{0}'.format(identifier))
+    hits = int(request.args.get('hits', 150))
+    timeout = float(request.args.get('timeout', 30))
+    deadline = time.ticks_add(time.ticks_ms(), int(timeout * 1000))
+    seen = buffer.count
     positive_count = 0
-    while time.time() - t < 30:
-        # time.sleep(0.001)
-        # piezo.calibrate()
-        value = piezo.touch_begins()
-        print(value)
-        if value:
-            positive_count += 1
-            if positive_count > 150:
+    while time.ticks_diff(deadline, time.ticks_ms()) > 0:
+        count = buffer.count
+        if count != seen:
+            # the samples taken since the last look, the buffer keeps 1.28 s
+            new = min(count - seen, buffer.size)
+            positive_count += round(buffer.aggregate(new)['mean'] * new)
+            seen = count
+            if positive_count > hits:
                 return {'value': True}
+        time.sleep_ms(10)
     return {'value': False}
 
 
@@ -102,7 +226,7 @@ def emergency_stop(request):
     return 'OK'
 
 
-@app.get("/status")
+@app.get("/status", cache=True)
 def motors(request):
     return 'OK'
 
@@ -0,0 +1,175 @@
+from array import array
+import _thread
+import time
+
+
+class RingBuffer:
+    """Fixed-size buffer with the latest samples of a sensor.
+
+    All the memory is allocated on creation, so appending a sample does not
+    allocate. Each sample is stored with the ``ticks_ms`` of its reading.
+    """
+
+    def __init__(self, size, width=1, typecode='f'):
+        """
+        size: Number of samples kept, older samples are overwritten.
+        width: Number of values in each sample (3 for an RGB reading).
+        typecode: The ``array`` type code of the values.
+        """
+        self.size = size
+        self.width = width
+        self.values = array(typecode, [0] * (size * width))
+        self.ticks = array('i', [0] * size)
+        self.count = 0  # samples written since creation
+
+    def append(self, values):
+        index = self.count % self.size
+        base = index * self.width
+        if self.width == 1:
+            self.values[base] = values
+        else:
+            for i in range(self.width):
+                self.values[base + i] = values[i]
+        self.ticks[index] = time.ticks_ms()
+        # published last, so readers never see a half written sample
+        self.count += 1
+
+    def _sample(self, index):
+        base = index * self.width
+        if self.width == 1:
+            return self.values[base]
+        return tuple(self.values[base:base + self.width])
+
+    def latest(self):
+        """Return the most recent sample as ``(age_ms, values)``, or ``None``
+        if nothing was sampled yet."""
+        if not self.count:
+            return None
+        index = (self.count - 1) % self.size
+        return (time.ticks_diff(time.ticks_ms(), self.ticks[index]),
+                self._sample(index))
+
+    def window(self, n=None):
+        """Return up to ``n`` of the most recent samples, oldest first, as a
+        list of ``(age_ms, values)`` tuples."""
+        count = min(self.count, self.size, n or self.size)
+        now = time.ticks_ms()
+        samples = []
+        for i in range(self.count - count, self.count):
+            index = i % self.size
+            samples.append((time.ticks_diff(now, self.ticks[index]),
+                            self._sample(index)))
+        return samples
+
+    def aggregate(self, n=None):
+        """Return the count, minimum, maximum and mean of each value over the
+        ``n`` most recent samples."""
+        count = min(self.count, self.size, n or self.size)
+        width = self.width
+        low = [None] * width
+        high = [None] * width
+        total = [0] * width
+        for i in range(self.count - count, self.count):
+            base = (i % self.size) * width
+            for j in range(width):
+                value = self.values[base + j]
+                total[j] += value
+                if low[j] is None or value < low[j]:
+                    low[j] = value
+                if high[j] is None or value > high[j]:
+                    high[j] = value
+        mean = [value / count for value in total] if count else low
+        if width == 1:
+            return {'count': count, 'min': low[0], 'max': high[0],
+                    'mean': mean[0]}
+        return {'count': count, 'min': low, 'max': high, 'mean': mean}
+
+
+class Sampler:
+    """Reads sensors in background threads, each one at its own rate, and
+    keeps their readings in ring buffers.
+
+    Request handlers read the buffers instead of the sensors, so their
+    latency does not include the sensor timing (38.4 ms of integration for
+    the TCS34725 at ``TCSINTEG_MEDIUM``, up to 30 ms of echo for the HC-SR04).
+
+    The channels of a thread are read in turn, so a reading that blocks
+    delays the others of its thread: fast sensors go in a thread apart from
+    the slow ones. A reading that comes after the next one was due counts
+    the skipped periods in ``missed``.
+    """
+
+    def __init__(self):
+        self.channels = {}
+        self.running = False
+
+    def add(self, name, read, period_ms, size=64, width=1, typecode='f',
+            thread=0):
+        """
+        Add a sensor and return its ring buffer.
+        name: Name of the channel.
+        read: Function that returns a reading, a number or a tuple of
+        ``width`` numbers. Readings that raise an exception are counted in
+        ``errors`` and skipped.
+        period_ms: Time between readings.
+        size, width, typecode: See RingBuffer.
+        thread: Number of the thread that reads the sensor.
+        """
+        buffer = RingBuffer(size, width, typecode)
+        self.channels[name] = {'read': read, 'period_ms': period_ms,
+                               'buffer': buffer, 'due': time.ticks_ms(),
+                               'errors': 0, 'missed': 0, 'thread': thread}
+        return buffer
+
+    def buffer(self, name):
+        return self.channels[name]['buffer']
+
+    def set_period(self, name, period_ms):
+        channel = self.channels[name]
+        channel['period_ms'] = period_ms
+        channel['due'] = time.ticks_ms()
+
+    def stats(self):
+        return {name: {'period_ms': channel['period_ms'],
+                       'samples': channel['buffer'].count,
+                       'errors': channel['errors'],
+                       'missed': channel['missed']}
+                for name, channel in self.channels.items()}
+
+    def start(self):
+        if not self.running:
+            self.running = True
+            threads = []
+            for channel in self.channels.values():
+                if channel['thread'] not in threads:
+                    threads.append(channel['thread'])
+            for thread in threads:
+                _thread.start_new_thread(self._run, (
+                    [channel for channel in self.channels.values()
+                     if channel['thread'] == thread],))
+
+    def stop(self):
+        self.running = False
+
+    def _run(self, channels):
+        while self.running:
+            now = time.ticks_ms()
+            wait = 1000
+            for channel in channels:
+                if time.ticks_diff(now, channel['due']) >= 0:
+                    try:
+                        channel['buffer'].append(channel['read']())
+                    except Exception:
+                        channel['errors'] += 1
+                    now = time.ticks_ms()
+                    period = channel['period_ms']
+                    due = time.ticks_add(channel['due'], period)
+                    late = time.ticks_diff(now, due)
+                    if late > 0:
+                        # fell behind, do not try to catch up
+                        channel['missed'] += late // period + 1
+                        due = time.ticks_add(now, period)
+                    channel['due'] = due
+                wait = min(wait, time.ticks_diff(channel['due'], now))
+            if wait > 0:
+                time.sleep_ms(wait)
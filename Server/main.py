@@ -1,6 +1,10 @@
 from microdns import MicroDNSSrv
 
-if MicroDNSSrv.Create({"sensors.ita": "192.168.4.3", "motors.ita": "192.168.4.4"}):
+mds = MicroDNSSrv.Create({"sensors.ita": "192.168.4.3", "motors.ita": "192.168.4.4"})
+if mds:
     print("MicroDNSSrv started.")
+    # Upload a domains.json ({"sensors.ita": "192.168.4.3", ...}) to re-map
+    # the names without restarting
+    mds.WatchFile("domains.json")
 else:
     print("Error to starts MicroDNSSrv...")
@@ -3,11 +3,51 @@ The MIT License (MIT)
 Copyright © 2018 Jean-Christophe Bos & HC² (www.hc2.fr)
 """
 
-from _thread import start_new_thread
-from re import match
+from _thread import start_new_thread, allocate_lock
+from re import compile
+from time import sleep
 import socket
+import json
+import os
 import gc
 
+try:
+    from collections import OrderedDict
+except ImportError:
+    from ucollections import OrderedDict
+
+try:
+    from random import getrandbits
+except ImportError:
+    from urandom import getrandbits
+
+try:
+    import uasyncio as asyncio
+except ImportError:
+    import asyncio
+
+try:
+    from time import ticks_ms, ticks_diff
+except ImportError:
+    from time import monotonic
+
+    def ticks_ms():
+        return int(monotonic() * 1000)
+
+    def ticks_diff(a, b):
+        return a - b
+
+
+TYPE_A = 1
+TYPE_SOA = 6
+TYPE_PTR = 12
+TYPE_AAAA = 28
+TYPE_OPT = 41
+TYPE_ANY = 255
+CLASS_IN = 1
+CLASS_ANY = 255
+RCODE_NXDOMAIN = 3
+
 
 class MicroDNSSrv:
 
@@ -64,21 +104,70 @@ class MicroDNSSrv:
     # ----------------------------------------------------------------------------
 
     @staticmethod
-    def _getAskedDomainName(packet):
+    def _ipV6StrToBytes(ipStr):
+        try:
+            head, sep, tail = ipStr.partition('::')
+            head = head.split(':') if head else []
+            tail = tail.split(':') if tail else []
+            missing = 8 - len(head) - len(tail)
+            if (sep and missing > 0) or (not sep and missing == 0):
+                words = head + ['0'] * missing + tail
+                o = bytearray()
+                for word in words:
+                    w = int(word, 16)
+                    if not 0 <= w <= 0xFFFF:
+                        return None
+                    o.append(w >> 8)
+                    o.append(w & 0xFF)
+                return bytes(o)
+        except:
+            pass
+        return None
+
+    # ----------------------------------------------------------------------------
+
+    @staticmethod
+    def _ipStrToBytes(ipStr):
+        if isinstance(ipStr, str):
+            if ipStr.find(':') >= 0:
+                return MicroDNSSrv._ipV6StrToBytes(ipStr)
+            return MicroDNSSrv._ipV4StrToBytes(ipStr)
+        return None
+
+    # ----------------------------------------------------------------------------
+
+    @staticmethod
+    def _reverseName(ipBytes):
+        # The in-addr.arpa or ip6.arpa name of an address, for PTR queries
+        if len(ipBytes) == 4:
+            return '.'.join([str(b) for b in reversed(ipBytes)]) + \
+                   '.in-addr.arpa'
+        nibbles = []
+        for b in reversed(ipBytes):
+            nibbles.append('%x' % (b & 15))
+            nibbles.append('%x' % (b >> 4))
+        return '.'.join(nibbles) + '.ip6.arpa'
+
+    # ----------------------------------------------------------------------------
+
+    @staticmethod
+    def _getNameEnd(packet, size):
+        # End of the asked name, after its zero length label, in a standard
+        # query with one question, or None
         try:
             queryType = (packet[2] >> 3) & 15
             qCount = (packet[4] << 8) | packet[5]
             if queryType == 0 and qCount == 1:
                 pos = 12
-                domName = ''
                 while True:
                     domPartLen = packet[pos]
                     if (domPartLen == 0):
                         break
-                    domName += ('.' if len(domName) > 0 else '') \
-                               + packet[pos + 1: pos + 1 + domPartLen].decode()
+                    if domPartLen > 63:
+                        return None
                     pos += 1 + domPartLen
-                return domName
+                if pos + 5 <= size:
+                    return pos + 1
         except:
             pass
         return None
@@ -86,37 +175,174 @@ class MicroDNSSrv:
     # ----------------------------------------------------------------------------
 
     @staticmethod
-    def _getPacketAnswerA(packet, ipV4Bytes):
+    def _nameToWire(domName):
+        return b''.join([bytes([len(label)]) + label.encode()
+                         for label in domName.split('.')]) + b'\x00'
 
-        try:
+    # ----------------------------------------------------------------------------
 
-            queryEndPos = 12
-            while True:
-                domPartLen = packet[queryEndPos]
-                if (domPartLen == 0):
-                    break
-                queryEndPos += 1 + domPartLen
-            queryEndPos += 5
-
-            return b''.join([
-                packet[:2],  # Query identifier
-                b'\x85\x80',  # Flags and codes
-                packet[4:6],  # Query question count
-                b'\x00\x01',  # Answer record count
-                b'\x00\x00',  # Authority record count
-                b'\x00\x00',  # Additional record count
-                packet[12:queryEndPos],  # Query question
-                b'\xc0\x0c',  # Answer name as pointer
-                b'\x00\x01',  # Answer type A
-                b'\x00\x01',  # Answer class IN
-                b'\x00\x00\x00\x1E',  # Answer TTL 30 secondes
-                b'\x00\x04',  # Answer data length
-                ipV4Bytes])  # Answer data
+    @staticmethod
+    def _wireToName(wireName):
+        labels = []
+        pos = 0
+        while wireName[pos]:
+            labels.append(wireName[pos + 1:pos + 1 + wireName[pos]].decode())
+            pos += 1 + wireName[pos]
+        return '.'.join(labels)
 
-        except:
-            pass
+    # ----------------------------------------------------------------------------
 
-        return None
+    @staticmethod
+    def _foldName(packet, start, nameEnd, end, folded):
+        # Copy packet[start:end] into the bytearray folded, with the name up
+        # to nameEnd in lower case, and return a hash of the copy. Label
+        # lengths are below 64 so they are not changed, and the hash stays
+        # a small int, so nothing is allocated
+        h = 0
+        j = 0
+        for i in range(start, end):
+            c = packet[i]
+            if 64 < c < 91 and i < nameEnd:
+                c += 32
+            folded[j] = c
+            h = (h * 31 + c) & 0x1FFFFFF
+            j += 1
+        return h
+
+    # ----------------------------------------------------------------------------
+
+    @staticmethod
+    def _getAnswer(qType, data):
+        # An answer record that follows the question, encoded once
+        return b''.join([
+            b'\xc0\x0c',  # Answer name as pointer
+            bytes([qType >> 8, qType & 0xFF]),  # Answer type
+            b'\x00\x01',  # Answer class IN
+            b'\x00\x00\x00\x1E',  # Answer TTL 30 secondes
+            bytes([len(data) >> 8, len(data) & 0xFF]),  # Answer data length
+            data])  # Answer data
+
+    # ----------------------------------------------------------------------------
+
+    @staticmethod
+    def _buildRecords(addresses, ptrName=None):
+        # The answers of a name by query type: [next, answers, count], where
+        # answers has every rotation of the records, so each query gets the
+        # next one (round robin)
+        records = {}
+        everything = []
+        count = 0
+        for qType, size in ((TYPE_A, 4), (TYPE_AAAA, 16)):
+            answers = [MicroDNSSrv._getAnswer(qType, ipB)
+                       for ipB in addresses if len(ipB) == size]
+            if answers:
+                records[qType] = [0, [b''.join(answers[i:] + answers[:i])
+                                      for i in range(len(answers))],
+                                  len(answers)]
+                everything.extend(answers)
+        if ptrName:
+            answer = MicroDNSSrv._getAnswer(TYPE_PTR,
+                                            MicroDNSSrv._nameToWire(ptrName))
+            records[TYPE_PTR] = [0, [answer], 1]
+            everything.append(answer)
+        if everything:
+            records[TYPE_ANY] = [0, [b''.join(everything)], len(everything)]
+        return records
+
+    # ----------------------------------------------------------------------------
+
+    @staticmethod
+    def _buildIndex(domList):
+        # Exact names are looked up by the hash of their wire format, with
+        # a bytearray of each of their lengths to fold the asked name into,
+        # '*.<suffix>' names in a trie of the suffix labels from the last
+        # one, other wildcard names are compiled once to regular expressions,
+        # and '*' answers the others. Names are in their wire format, and
+        # map to their records. Exact names also answer the PTR queries of
+        # their addresses.
+        names = {}
+        suffixes = {}
+        patterns = []
+        default = None
+        reverse = {}
+        for dom, addresses in domList.items():
+            records = MicroDNSSrv._buildRecords(addresses)
+            if dom == '*':
+                default = records
+            elif dom.find('*') < 0:
+                names[MicroDNSSrv._nameToWire(dom)] = records
+                for ipB in addresses:
+                    if ipB not in reverse:
+                        reverse[ipB] = dom
+            elif dom.startswith('*.') and dom.find('*', 1) < 0:
+                node = suffixes
+                for label in reversed(dom[2:].split('.')):
+                    node = node.setdefault(label.encode(), {})
+                # b'' is never a label, it holds the records of the node
+                node[b''] = records
+            else:
+                r = dom.replace('.', '\\.').replace('*', '.*') + '$'
+                patterns.append((compile(r), records))
+        for ipB, dom in reverse.items():
+            wireName = MicroDNSSrv._nameToWire(MicroDNSSrv._reverseName(ipB))
+            if wireName not in names:
+                names[wireName] = MicroDNSSrv._buildRecords((), dom)
+        exact = {}
+        folded = {}
+        for wireName, records in names.items():
+            size = len(wireName)
+            if size not in folded:
+                folded[size] = bytearray(size)
+            h = MicroDNSSrv._foldName(wireName, 0, size, size, folded[size])
+            exact.setdefault(h, []).append((wireName, records))
+        return (exact, folded, suffixes, patterns, default)
+
+    # ----------------------------------------------------------------------------
+
+    @staticmethod
+    def _lookup(index, packet, nameEnd):
+        # The records of the name asked in a packet, None if it is not in the
+        # list. Exact names are compared with the name folded in place, the
+        # bytes of the name are only made for the wildcard names
+        exact, folded, suffixes, patterns, default = index
+        size = nameEnd - 12
+        name = folded.get(size, None)
+        if name is not None:
+            h = MicroDNSSrv._foldName(packet, 12, nameEnd, nameEnd, name)
+            for wireName, answer in exact.get(h, ()):
+                if name == wireName:
+                    return answer
+        if not suffixes and not patterns:
+            return default
+        # names are not case sensitive, lengths are below 64 so they are not
+        # changed by lower()
+        wireName = bytes(packet[12:nameEnd]).lower()
+        answer = None
+        if suffixes:
+            # the longest '*.<suffix>' matching, with at least one label
+            # before the suffix
+            starts = []
+            pos = 0
+            while wireName[pos]:
+                starts.append(pos)
+                pos += 1 + wireName[pos]
+            node = suffixes
+            i = len(starts) - 1
+            while i > 0:
+                pos = starts[i]
+                node = node.get(wireName[pos + 1:pos + 1 + wireName[pos]], None)
+                if node is None:
+                    break
+                answer = node.get(b'', answer)
+                i -= 1
+            if answer is not None:
+                return answer
+        if patterns:
+            domName = MicroDNSSrv._wireToName(wireName)
+            for r, answer in patterns:
+                if r.match(domName):
+                    return answer
+        return default
 
     # ============================================================================
     # ===( Constructor )==========================================================
@@ -124,7 +350,96 @@ class MicroDNSSrv:
 
     def __init__(self):
         self._domList = {}
+        self._index = MicroDNSSrv._buildIndex({})
         self._started = False
+        self._buf = bytearray(512)
+        self._bufView = memoryview(self._buf)
+        self._reply = bytearray(512)
+        self._replyView = memoryview(self._reply)
+        self._waiters = {}
+        self._forwarder = None
+        self._updateLock = allocate_lock()
+        self._watching = False
+        self._reloads = 0
+        self._reloadErrors = 0
+        self.ResetStats()
+
+    # ============================================================================
+    # ===( Domains List )=========================================================
+    # ============================================================================
+
+    @staticmethod
+    def _parseDomainsList(domainsList, removals):
+        # {lower case name: [address bytes]}, with None for the names to
+        # remove if `removals`, or None if any entry is not valid
+        if not isinstance(domainsList, dict):
+            return None
+        o = {}
+        for dom, ips in domainsList.items():
+            if not isinstance(dom, str) or len(dom) == 0:
+                return None
+            if ips is None and removals:
+                o[dom.lower()] = None
+                continue
+            if isinstance(ips, str):
+                ips = [ips]
+            try:
+                addresses = [MicroDNSSrv._ipStrToBytes(ip) for ip in ips]
+            except TypeError:
+                return None
+            if not addresses or None in addresses:
+                return None
+            o[dom.lower()] = addresses
+        return o
+
+    # ----------------------------------------------------------------------------
+
+    @staticmethod
+    def _ipBytesToStr(ipBytes):
+        if len(ipBytes) == 4:
+            return '.'.join([str(b) for b in ipBytes])
+        return ':'.join(['%x' % ((ipBytes[i] << 8) | ipBytes[i + 1])
+                         for i in range(0, 16, 2)])
+
+    # ----------------------------------------------------------------------------
+
+    def _swap(self, domList):
+        # Copy on write: a new index is built aside, then replaces the one the
+        # server reads in a single assignment, so a packet is answered from
+        # either the old or the new list, never from a list being changed.
+        # Called with the update lock held, so updates are not lost.
+        index = MicroDNSSrv._buildIndex(domList)
+        self._domList = domList
+        self._index = index
+        self._reloads += 1
+
+    # ----------------------------------------------------------------------------
+
+    def _checkFile(self, path, stamp):
+        # Loads the file if its size or time changed since `stamp`, returns
+        # the new stamp
+        try:
+            st = os.stat(path)
+        except OSError:
+            return stamp
+        newStamp = (st[6], st[8])
+        if newStamp != stamp:
+            try:
+                with open(path) as f:
+                    domainsList = json.load(f)
+            except:
+                domainsList = None
+            if not self.SetDomainsList(domainsList):
+                self._reloadErrors += 1
+        return newStamp
+
+    # ----------------------------------------------------------------------------
+
+    def _watchProcess(self, path, interval):
+        stamp = None
+        while self._watching:
+            stamp = self._checkFile(path, stamp)
+            sleep(interval)
 
     # ============================================================================
     # ===( Server Thread )========================================================
@@ -134,51 +449,213 @@ class MicroDNSSrv:
         self._started = True
         while True:
             try:
-                packet, cliAddr = self._server.recvfrom(256)
-                domName = MicroDNSSrv._getAskedDomainName(packet)
-                if domName:
-                    domName = domName.lower()
-                    ipB = self._domList.get(domName, None)
-                    if not ipB:
-                        for domChk in self._domList.keys():
-                            if domChk.find('*') >= 0:
-                                r = domChk.replace('.', '\.').replace('*', '.*') + '$'
-                                if match(r, domName):
-                                    ipB = self._domList.get(domChk, None)
-                                    break
-                        if not ipB:
-                            ipB = self._domList.get('*', None)
-                    if ipB:
-                        packet = MicroDNSSrv._getPacketAnswerA(packet, ipB)
-                        if packet:
-                            self._server.sendto(packet, cliAddr)
+                self._processPacket(*self._receive())
             except:
                 if not self._started:
                     break
+                self._errors += 1
+
+    # ----------------------------------------------------------------------------
+
+    def _upstreamProcess(self):
+        forwarder = self._forwarder
+        while self._started:
+            try:
+                forwarder.Receive()
+            except:
+                # timeout, or closed by Stop()
+                pass
+            # forget the queries upstream did not answer
+            forwarder.Expire()
+
+    # ============================================================================
+    # ===( Packets )==============================================================
+    # ============================================================================
+
+    def _openSocket(self, port):
+        self._server = socket.socket(socket.AF_INET,
+                                     socket.SOCK_DGRAM,
+                                     socket.IPPROTO_UDP)
+        self._server.setsockopt(socket.SOL_SOCKET,
+                                socket.SO_REUSEADDR,
+                                1)
+        self._server.bind(('0.0.0.0', port))
+        # MicroPython sockets have no recvfrom_into, they allocate each packet
+        self._recvInto = hasattr(self._server, 'recvfrom_into')
+
+    # ----------------------------------------------------------------------------
+
+    def _receive(self):
+        # Raises OSError when a non blocking socket has no packet
+        if self._recvInto:
+            size, cliAddr = self._server.recvfrom_into(self._buf)
+            return self._bufView[:size], cliAddr
+        return self._server.recvfrom(len(self._buf))
+
+    # ----------------------------------------------------------------------------
+
+    def _processPacket(self, packet, cliAddr):
+        self._queries += 1
+        nameEnd = MicroDNSSrv._getNameEnd(packet, len(packet))
+        if nameEnd:
+            qType = (packet[nameEnd] << 8) | packet[nameEnd + 1]
+            qClass = (packet[nameEnd + 2] << 8) | packet[nameEnd + 3]
+            if qClass == CLASS_IN or qClass == CLASS_ANY:
+                records = MicroDNSSrv._lookup(self._index, packet, nameEnd)
+                if records is None and self._forwarder is not None:
+                    self._forwarder.Forward(packet, nameEnd, cliAddr)
+                    return
+                if records is None:
+                    # the client does not wait for a timeout
+                    reply = self._writeReply(packet, nameEnd, RCODE_NXDOMAIN)
+                    self._nxdomain += 1
+                else:
+                    rrset = records.get(qType, None)
+                    if rrset is None:
+                        reply = self._writeReply(packet, nameEnd)
+                        self._nodata += 1
+                    else:
+                        i = rrset[0]
+                        answers = rrset[1]
+                        rrset[0] = (i + 1) % len(answers)
+                        reply = self._writeReply(packet, nameEnd, 0,
+                                                 rrset[2], answers[i])
+                        self._answers += 1
+                self._server.sendto(reply, cliAddr)
+                return
+        self._dropped += 1
+
+    # ----------------------------------------------------------------------------
+
+    def _writeReply(self, packet, nameEnd, rCode=0, count=0, answer=b''):
+        # The query identifier and question, then the answers, in the reply
+        # buffer
+        questionEnd = nameEnd + 4
+        end = questionEnd + len(answer)
+        reply = self._reply
+        if end > len(reply):
+            # truncated, the client can ask again over TCP
+            end = questionEnd
+            count = 0
+            answer = b''
+            rCode |= 0x200
+        reply[:questionEnd] = packet[:questionEnd]
+        reply[2] = 0x85 | (rCode >> 8)  # Flags and codes
+        reply[3] = 0x80 | (rCode & 0xFF)
+        # Answer, authority and additional record counts
+        reply[6] = count >> 8
+        reply[7] = count & 0xFF
+        reply[8:12] = b'\x00\x00\x00\x00'
+        reply[questionEnd:end] = answer
+        return self._replyView[:end]
+
+    # ============================================================================
+    # ===( Server Task )==========================================================
+    # ============================================================================
+
+    @staticmethod
+    def _uWait(sock):
+        # uasyncio wakes the task up when the socket is readable
+        yield asyncio.core._io_queue.queue_read(sock)
+
+    # ----------------------------------------------------------------------------
+
+    def _readable(self, sock):
+        if hasattr(asyncio, 'core'):
+            return MicroDNSSrv._uWait(sock)
+        loop = asyncio.get_event_loop()
+        waiter = loop.create_future()
+        fd = sock.fileno()
+        self._waiters[fd] = waiter
+
+        def ready():
+            loop.remove_reader(fd)
+            if not waiter.done():
+                waiter.set_result(None)
+
+        loop.add_reader(fd, ready)
+        return waiter
+
+    # ----------------------------------------------------------------------------
+
+    async def _serveUpstream(self, batch):
+        forwarder = self._forwarder
+        while self._started:
+            await self._readable(forwarder._sock)
+            for _ in range(batch):
+                try:
+                    forwarder.Receive()
+                except OSError:
+                    break
+                except:
+                    self._errors += 1
+            forwarder.Expire()
+            await asyncio.sleep(0)
+
+    # ----------------------------------------------------------------------------
+
+    async def ServeAsync(self, port=53, batch=16):
+        # Serves from the running event loop, next to other tasks such as a
+        # microdot_asyncio server:
+        #   asyncio.create_task(mds.ServeAsync())
+        #   await app.start_server(port=80)
+        # Every wakeup answers up to `batch` queued packets, then yields.
+        if self._started:
+            return False
+        self._openSocket(port)
+        self._server.setblocking(False)
+        self._started = True
+        if self._forwarder is not None:
+            self._forwarder.Open(self._server.sendto, 0)
+            asyncio.create_task(self._serveUpstream(batch))
+        while self._started:
+            await self._readable(self._server)
+            self._wakeups += 1
+            for _ in range(batch):
+                try:
+                    received = self._receive()
+                except OSError:
+                    # no more packets, or closed by Stop()
+                    break
+                try:
+                    self._processPacket(*received)
+                except:
+                    self._errors += 1
+            await asyncio.sleep(0)
+        return True
 
     # ============================================================================
     # ===( Functions )============================================================
     # ============================================================================
 
-    def Start(self):
+    def Start(self, port=53):
         if not self._started:
-            self._server = socket.socket(socket.AF_INET,
-                                         socket.SOCK_DGRAM,
-                                         socket.IPPROTO_UDP)
-            self._server.setsockopt(socket.SOL_SOCKET,
-                                    socket.SO_REUSEADDR,
-                                    1)
-            self._server.bind(('0.0.0.0', 53))
+            self._openSocket(port)
             self._server.setblocking(True)
+            if self._forwarder is not None:
+                self._forwarder.Open(self._server.sendto, 1)
+                # before the thread starts, it stops when this is False
+                self._started = True
+                if not MicroDNSSrv._tryStartThread(self._upstreamProcess):
+                    self.Stop()
+                    return False
             return MicroDNSSrv._tryStartThread(self._serverProcess)
         return False
 
     # ----------------------------------------------------------------------------
 
     def Stop(self):
+        self._watching = False
         if self._started:
             self._started = False
+            for fd, waiter in self._waiters.items():
+                if not waiter.done():
+                    # wake ServeAsync() up, the socket will not
+                    waiter.get_loop().remove_reader(fd)
+                    waiter.set_result(None)
             self._server.close()
+            if self._forwarder is not None:
+                self._forwarder.Close()
             return True
         return False
 
@@ -189,21 +666,566 @@ class MicroDNSSrv:
 
     # ----------------------------------------------------------------------------
 
+    def ResetStats(self):
+        self._statsStart = ticks_ms()
+        self._queries = 0
+        self._answers = 0
+        self._nxdomain = 0
+        self._nodata = 0
+        self._dropped = 0
+        self._errors = 0
+        self._wakeups = 0
+
+    # ----------------------------------------------------------------------------
+
+    def GetStats(self):
+        # nxdomain: names not in the list, nodata: names without records of
+        # the type asked, dropped: queries not answered (not standard, or not
+        # of class IN), errors: packets that could not be read or answered
+        seconds = ticks_diff(ticks_ms(), self._statsStart) / 1000
+        return {'queries': self._queries,
+                'answers': self._answers,
+                'nxdomain': self._nxdomain,
+                'nodata': self._nodata,
+                'dropped': self._dropped,
+                'errors': self._errors,
+                'wakeups': self._wakeups,
+                'queries_per_second': self._queries / seconds if seconds else 0,
+                'reloads': self._reloads,
+                'reload_errors': self._reloadErrors,
+                'forwarder': self._forwarder.GetStats()
+                if self._forwarder is not None else None}
+
+    # ----------------------------------------------------------------------------
+
+    def SetForwarder(self, upstreamIP, port=53, cacheSize=64, timeout=2,
+                     negativeTTL=30):
+        # Names not in the list are asked to an upstream DNS server instead of
+        # answered NXDOMAIN, its answers are cached; set before starting
+        if self._started or not MicroDNSSrv._ipV4StrToBytes(upstreamIP):
+            return False
+        self._forwarder = MicroDNSForwarder((upstreamIP, port), cacheSize,
+                                            timeout, negativeTTL)
+        return True
+
+    # ----------------------------------------------------------------------------
+
     def SetDomainsList(self, domainsList):
-        if domainsList and isinstance(domainsList, dict):
-            o = {}
-            for dom, ip in domainsList.items():
-                if isinstance(dom, str) and len(dom) > 0:
-                    ipB = MicroDNSSrv._ipV4StrToBytes(ip)
-                    if ipB:
-                        o[dom.lower()] = ipB
-                        continue
-                break
-            if len(o) == len(domainsList):
-                self._domList = o
+        # {name: address}, or {name: [addresses]} to answer several A records
+        # in turn; IPv6 addresses are answered to AAAA queries
+        if domainsList:
+            o = MicroDNSSrv._parseDomainsList(domainsList, False)
+            if o is not None:
+                with self._updateLock:
+                    self._swap(o)
                 return True
         return False
 
+    # ----------------------------------------------------------------------------
+
+    def UpdateDomainsList(self, changes):
+        # Adds or replaces the names of {name: address or [addresses]}, and
+        # removes the names of {name: None}, all at once, while serving
+        o = MicroDNSSrv._parseDomainsList(changes, True)
+        if o is None:
+            return False
+        with self._updateLock:
+            domList = dict(self._domList)
+            for dom, addresses in o.items():
+                if addresses is None:
+                    domList.pop(dom, None)
+                else:
+                    domList[dom] = addresses
+            self._swap(domList)
+        return True
+
+    # ----------------------------------------------------------------------------
+
+    def SetDomain(self, domName, ips):
+        return self.UpdateDomainsList({domName: ips})
+
+    # ----------------------------------------------------------------------------
+
+    def RemoveDomain(self, domName):
+        if domName.lower() not in self._domList:
+            return False
+        return self.UpdateDomainsList({domName: None})
+
+    # ----------------------------------------------------------------------------
+
+    def GetDomainsList(self):
+        return dict([(dom, [MicroDNSSrv._ipBytesToStr(ipB) for ipB in addresses])
+                     for dom, addresses in self._domList.items()])
+
+    # ----------------------------------------------------------------------------
+
+    def WatchFile(self, path, interval=2):
+        # Loads the domains list from a JSON file, {name: address or
+        # [addresses]}, each time it changes, from a thread
+        self._watching = True
+        return MicroDNSSrv._tryStartThread(self._watchProcess, (path, interval))
+
+    # ----------------------------------------------------------------------------
+
+    async def WatchFileAsync(self, path, interval=2):
+        # WatchFile() as a task of the running event loop
+        self._watching = True
+        stamp = None
+        while self._watching:
+            stamp = self._checkFile(path, stamp)
+            await asyncio.sleep(interval)
+
+    # ----------------------------------------------------------------------------
+
+    def StopWatch(self):
+        self._watching = False
+
+    # ============================================================================
+    # ============================================================================
+    # ============================================================================
+
+
+class MicroDNSForwarder:
+
+    # ============================================================================
+    # ===( Constructor )==========================================================
     # ============================================================================
+
+    def __init__(self, upstream, cacheSize=64, timeout=2, negativeTTL=30,
+                 maxTTL=3600):
+        self._upstream = upstream
+        self._cacheSize = cacheSize
+        self._timeoutMs = int(timeout * 1000)
+        self._negativeTTL = negativeTTL
+        self._maxTTL = maxTTL
+        # questions (name in lower case, type and class) are found by their
+        # hash, folded into the bytearray of their length, and compared with
+        # the key kept with them
+        self._questions = {}
+        # hash -> (key, response, [(ttl offset, ttl)], ticks, ttl), least
+        # recently used first
+        self._cache = OrderedDict()
+        # upstream query identifier -> [key, [(identifier, address)], ticks,
+        # hash]
+        self._pending = {}
+        self._pendingKeys = {}
+        self._nextId = getrandbits(16)
+        self._lock = allocate_lock()
+        self._sock = None
+        self._send = None
+        # one byte more than an answer can have, to see the longer ones
+        self._buf = bytearray(513)
+        self._bufView = memoryview(self._buf)
+        self._out = bytearray(512)
+        self._outView = memoryview(self._out)
+        self.ResetStats()
+
     # ============================================================================
+    # ===( Utils )================================================================
     # ============================================================================
+
+    @staticmethod
+    def _skipName(packet, pos):
+        while True:
+            length = packet[pos]
+            if length == 0:
+                return pos + 1
+            if length & 0xC0 == 0xC0:
+                return pos + 2
+            pos += 1 + length
+
+    # ----------------------------------------------------------------------------
+
+    @staticmethod
+    def _getTTLs(response, negativeTTL, maxTTL):
+        # The TTLs of the records (but OPT) with their offsets, and how long
+        # the response can be cached, None if it cannot: the lowest TTL of
+        # its answers, or for a name or type without records, the TTL of
+        # the SOA record up to negativeTTL
+        try:
+            rCode = response[3] & 15
+            if response[2] & 2 or (rCode != 0 and rCode != RCODE_NXDOMAIN):
+                return None, None
+            qCount = (response[4] << 8) | response[5]
+            anCount = (response[6] << 8) | response[7]
+            rrCount = anCount + ((response[8] << 8) | response[9]) + \
+                ((response[10] << 8) | response[11])
+            pos = 12
+            for _ in range(qCount):
+                pos = MicroDNSForwarder._skipName(response, pos) + 4
+            ttls = []
+            ttl = None
+            soaTTL = negativeTTL
+            for i in range(rrCount):
+                pos = MicroDNSForwarder._skipName(response, pos)
+                rType = (response[pos] << 8) | response[pos + 1]
+                rTTL = (response[pos + 4] << 24) | (response[pos + 5] << 16) | \
+                       (response[pos + 6] << 8) | response[pos + 7]
+                if rType != TYPE_OPT:
+                    ttls.append((pos + 4, rTTL))
+                    if i < anCount:
+                        ttl = rTTL if ttl is None else min(ttl, rTTL)
+                    elif rType == TYPE_SOA:
+                        soaTTL = min(soaTTL, rTTL)
+                pos += 10 + ((response[pos + 8] << 8) | response[pos + 9])
+            if pos > len(response):
+                return None, None
+            if rCode == RCODE_NXDOMAIN or ttl is None:
+                ttl = soaTTL
+            ttl = min(ttl, maxTTL)
+            if ttl > 0:
+                return ttls, ttl
+        except IndexError:
+            pass
+        return None, None
+
+    # ----------------------------------------------------------------------------
+
+    def _fold(self, packet, nameEnd):
+        # The hash of the question of a packet, folded into
+        # self._questions[nameEnd - 8]
+        size = nameEnd - 8
+        question = self._questions.get(size, None)
+        if question is None:
+            question = bytearray(size)
+            self._questions[size] = question
+        return MicroDNSSrv._foldName(packet, 12, nameEnd, nameEnd + 4,
+                                     question)
+
+    # ============================================================================
+    # ===( Cache )================================================================
+    # ============================================================================
+
+    def _fromCache(self, h, question, packet, now):
+        # The cached response with the identifier of the query and the TTLs
+        # that remain, in the output buffer, or None
+        entry = self._cache.get(h, None)
+        if entry is None or entry[0] != question:
+            return None
+        key, response, ttls, stored, ttl = entry
+        del self._cache[h]
+        elapsed = ticks_diff(now, stored) // 1000
+        if elapsed >= ttl:
+            self._expired += 1
+            return None
+        # the most recently used, last
+        self._cache[h] = entry
+        out = self._out
+        size = len(response)
+        out[:size] = response
+        out[0] = packet[0]
+        out[1] = packet[1]
+        for offset, rTTL in ttls:
+            rTTL = max(rTTL - elapsed, 0)
+            out[offset] = rTTL >> 24
+            out[offset + 1] = (rTTL >> 16) & 0xFF
+            out[offset + 2] = (rTTL >> 8) & 0xFF
+            out[offset + 3] = rTTL & 0xFF
+        return self._outView[:size]
+
+    # ----------------------------------------------------------------------------
+
+    def _store(self, h, key, response, now):
+        ttls, ttl = MicroDNSForwarder._getTTLs(response, self._negativeTTL,
+                                               self._maxTTL)
+        if ttl is None:
+            return
+        # a question with the same hash is replaced
+        self._cache.pop(h, None)
+        self._cache[h] = (key, bytes(response), ttls, now, ttl)
+        while len(self._cache) > self._cacheSize:
+            del self._cache[next(iter(self._cache))]
+            self._evictions += 1
+
+    # ============================================================================
+    # ===( Functions )============================================================
+    # ============================================================================
+
+    def Open(self, send, timeout):
+        # send: sends the replies to the clients, timeout of the socket: 0
+        # for non blocking
+        self._send = send
+        self._sock = socket.socket(socket.AF_INET,
+                                   socket.SOCK_DGRAM,
+                                   socket.IPPROTO_UDP)
+        self._sock.bind(('0.0.0.0', 0))
+        if timeout:
+            self._sock.settimeout(timeout)
+        else:
+            self._sock.setblocking(False)
+        self._recvInto = hasattr(self._sock, 'recvfrom_into')
+
+    # ----------------------------------------------------------------------------
+
+    def Close(self):
+        if self._sock is not None:
+            self._sock.close()
+            self._sock = None
+
+    # ----------------------------------------------------------------------------
+
+    def Forward(self, packet, nameEnd, cliAddr):
+        # Answer from the cache, or ask upstream; the same question asked
+        # again before the answer comes waits for it. Answers from the cache
+        # allocate nothing, the bytes of the question and of the identifier
+        # are only kept for the queries that wait
+        with self._lock:
+            h = self._fold(packet, nameEnd)
+            question = self._questions[nameEnd - 8]
+            now = ticks_ms()
+            reply = self._fromCache(h, question, packet, now)
+            if reply is not None:
+                self._hits += 1
+                self._send(reply, cliAddr)
+                return
+            self._expire(now)
+            identifier = bytes(packet[0:2])
+            upId = self._pendingKeys.get(h, None)
+            if upId is not None and self._pending[upId][0] == question:
+                self._pending[upId][1].append((identifier, cliAddr))
+                self._coalesced += 1
+                return
+            upId = self._nextId
+            self._nextId = (upId + 1) & 0xFFFF
+            # keep the identifier unique among the pending queries
+            self._drop(self._pending.get(upId, None), upId)
+            self._pending[upId] = [bytes(question), [(identifier, cliAddr)],
+                                   now, h]
+            # a question with the same hash no longer gets the answers
+            self._pendingKeys[h] = upId
+            self._forwarded += 1
+            # only the question: without the OPT record of an EDNS client,
+            # upstream answers in 512 bytes, or with TC set
+            size = nameEnd + 4
+            out = self._out
+            out[:size] = packet[:size]
+            out[0] = upId >> 8
+            out[1] = upId & 0xFF
+            out[6:12] = b'\x00\x00\x00\x00\x00\x00'
+            self._sock.sendto(self._outView[:size], self._upstream)
+
+    # ----------------------------------------------------------------------------
+
+    def Receive(self):
+        # Handle an answer from upstream, raises OSError when none comes
+        if self._recvInto:
+            size, addr = self._sock.recvfrom_into(self._buf)
+            response = self._bufView[:size]
+        else:
+            response, addr = self._sock.recvfrom(len(self._buf))
+            size = len(response)
+        if addr[0] != self._upstream[0] or size < 12:
+            return
+        upId = (response[0] << 8) | response[1]
+        with self._lock:
+            pending = self._pending.get(upId, None)
+            if pending is None:
+                self._late += 1
+                return
+            key = pending[0]
+            h = pending[3]
+            nameEnd = 12 + len(key) - 4
+            if size < nameEnd + 4 or self._fold(response, nameEnd) != h or \
+                    self._questions[len(key)] != key:
+                # not the question asked
+                return
+            del self._pending[upId]
+            if self._pendingKeys.get(h, None) == upId:
+                del self._pendingKeys[h]
+            out = self._out
+            if size > len(out):
+                # too long for UDP, the question with TC set, the client can
+                # ask again over TCP
+                self._truncated += 1
+                size = nameEnd + 4
+                out[:size] = response[:size]
+                out[2] |= 2
+                out[6:12] = b'\x00\x00\x00\x00\x00\x00'
+            else:
+                self._store(h, key, response, ticks_ms())
+                out[:size] = response
+            for identifier, cliAddr in pending[1]:
+                out[0:2] = identifier
+                self._send(self._outView[:size], cliAddr)
+
+    # ----------------------------------------------------------------------------
+
+    def _drop(self, pending, upId):
+        if pending is not None:
+            del self._pending[upId]
+            if self._pendingKeys.get(pending[3], None) == upId:
+                del self._pendingKeys[pending[3]]
+            self._timeouts += 1
+
+    # ----------------------------------------------------------------------------
+
+    def Expire(self):
+        # Forget the queries upstream did not answer in time, their clients
+        # ask again
+        with self._lock:
+            self._expire(ticks_ms())
+
+    # ----------------------------------------------------------------------------
+
+    def _expire(self, now):
+        if self._pending:
+            for upId in [upId for upId, pending in self._pending.items()
+                         if ticks_diff(now, pending[2]) > self._timeoutMs]:
+                self._drop(self._pending[upId], upId)
+
+    # ----------------------------------------------------------------------------
+
+    def ResetStats(self):
+        self._forwarded = 0
+        self._hits = 0
+        self._coalesced = 0
+        self._expired = 0
+        self._evictions = 0
+        self._timeouts = 0
+        self._late = 0
+        self._truncated = 0
+
+    # ----------------------------------------------------------------------------
+
+    def GetStats(self):
+        # forwarded: queries asked upstream, hits: answered from the cache,
+        # coalesced: answered with the answer to a query already asked,
+        # truncated: answers longer than 512 bytes, relayed with TC set
+        return {'forwarded': self._forwarded,
+                'hits': self._hits,
+                'coalesced': self._coalesced,
+                'cached': len(self._cache),
+                'expired': self._expired,
+                'evictions': self._evictions,
+                'timeouts': self._timeouts,
+                'pending': len(self._pending),
+                'late': self._late,
+                'truncated': self._truncated}
+
+    # ============================================================================
+    # ============================================================================
+    # ============================================================================
+
+
+# ============================================================================
+# ===( Benchmark )============================================================
+# ============================================================================
+
+# Answers per second to queries sent over loopback, with a table of exact and
+# wildcard names, served from the thread or from an asyncio task; `window`
+# queries are sent before reading their answers. In forward mode, the names
+# not in the table are forwarded to a stand-in upstream server on port + 1,
+# which answers after 20 ms. Then the time and memory allocated to answer one
+# query, without the socket:
+#   python3 microdns.py [queries] [port] [thread|async|forward] [window]
+
+if __name__ == '__main__':
+    import sys
+    import time
+    import threading
+
+    def _query(ident, domName):
+        return b''.join([bytes([ident >> 8, ident & 0xFF]),
+                         b'\x01\x00\x00\x01\x00\x00\x00\x00\x00\x00',
+                         b''.join([bytes([len(label)]) + label.encode()
+                                   for label in domName.split('.')]),
+                         b'\x00\x00\x01\x00\x01'])
+
+    def _client(queries, port, window):
+        client = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        client.settimeout(1)
+        answered = 0
+        t = time.time()
+        for i in range(0, len(queries), window):
+            for q in queries[i:i + window]:
+                client.sendto(q, ('127.0.0.1', port))
+            for q in queries[i:i + window]:
+                try:
+                    client.recvfrom(512)
+                    answered += 1
+                except OSError:
+                    break
+        return answered, time.time() - t
+
+    def _upstream(port):
+        # answers every A query with 10.0.0.1 and a 60 seconds TTL
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.bind(('127.0.0.1', port))
+        while True:
+            q, addr = sock.recvfrom(512)
+            time.sleep(0.02)
+            nameEnd = MicroDNSSrv._getNameEnd(q, len(q))
+            sock.sendto(b''.join([q[:2], b'\x81\x80\x00\x01\x00\x01',
+                                  b'\x00\x00\x00\x00', q[12:nameEnd + 4],
+                                  b'\xc0\x0c\x00\x01\x00\x01\x00\x00\x00\x3c',
+                                  b'\x00\x04\x0a\x00\x00\x01']), addr)
+
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    port = int(sys.argv[2]) if len(sys.argv) > 2 else 5353
+    mode = sys.argv[3] if len(sys.argv) > 3 else 'thread'
+    window = int(sys.argv[4]) if len(sys.argv) > 4 else 1
+    domains = {'sensors.ita': '192.168.4.3', 'motors.ita': '192.168.4.4'}
+    for i in range(100):
+        domains['node%d.ita' % i] = '192.168.5.%d' % i
+    for i in range(20):
+        domains['*.zone%d.ita' % i] = '192.168.6.%d' % i
+    domains['*'] = '192.168.4.1'
+    names = ['sensors.ita', 'motors.ita', 'node50.ita', 'a.zone3.ita',
+             'b.c.zone19.ita', 'unknown.example']
+    queries = [_query(i, names[i % len(names)]) for i in range(count)]
+    mds = MicroDNSSrv()
+    if mode == 'forward':
+        del domains['*']
+        threading.Thread(target=_upstream, args=(port + 1,), daemon=True).start()
+        mds.SetForwarder('127.0.0.1', port + 1)
+    mds.SetDomainsList(domains)
+    if mode == 'async':
+        async def _main():
+            task = asyncio.ensure_future(mds.ServeAsync(port))
+            await asyncio.sleep(0.1)
+            result = await asyncio.get_event_loop().run_in_executor(
+                None, _client, queries, port, window)
+            mds.Stop()
+            await task
+            return result
+        answered, t = asyncio.run(_main())
+    else:
+        mds.Start(port)
+        time.sleep(0.1)
+        answered, t = _client(queries, port, window)
+        mds.Stop()
+    print('%s, window %d: %d queries, %d answers, %.0f answers/second'
+          % (mode, window, count, answered, answered / t))
+    print(mds.GetStats())
+
+    class _NullSocket:
+        def sendto(self, data, addr):
+            pass
+
+    mds._server = _NullSocket()
+    if mds._forwarder is not None:
+        mds._forwarder._send = mds._server.sendto
+    for name in names:
+        q = _query(1, name)
+        mds._buf[:len(q)] = q
+        packet = mds._bufView[:len(q)]
+        t = time.time()
+        for i in range(count):
+            mds._processPacket(packet, None)
+        t = (time.time() - t) / count
+        if hasattr(gc, 'mem_alloc'):
+            gc.collect()
+            gc.disable()
+            allocated = gc.mem_alloc()
+            mds._processPacket(packet, None)
+            allocated = gc.mem_alloc() - allocated
+            gc.enable()
+        else:
+            # the most memory allocated at once
+            import tracemalloc
+            tracemalloc.start()
+            allocated = tracemalloc.get_traced_memory()[0]
+            mds._processPacket(packet, None)
+            allocated = tracemalloc.get_traced_memory()[1] - allocated
+            tracemalloc.stop()
+        print('%s: %.2f us, %d bytes allocated' % (name, t * 1000000, allocated))